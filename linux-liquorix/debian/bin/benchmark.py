@@ -0,0 +1,466 @@
+#!/usr/bin/python3
+
+# Benchmarks of the debian_linux code that runs on every package build,
+# on synthetic data generated from a fixed seed so that runs compare.
+# Run from the source package root, like gencontrol.py.
+
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append("debian/lib/python")
+
+from debian_linux.config import ConfigCoreDump, ConfigCoreHierarchy
+from debian_linux.debian import Changelog, PackageRelation, Version, \
+    VersionLinux, sort_versions
+from debian_linux.gencontrol import Gencontrol
+from debian_linux.kconfig import KconfigFile
+from debian_linux.utils import Templates, write_rfc822
+
+# Bump when the benchmarks or their data change, results of different
+# versions don't compare
+version = 5
+
+
+def gen_kconfig(rng, options):
+    lines = []
+    for i in range(options):
+        if i % 50 == 0:
+            lines.append('')
+            lines.append('## Section %d' % (i // 50))
+        name = 'SYMBOL_%05d' % i
+        kind = rng.random()
+        if kind < 0.45:
+            lines.append('CONFIG_%s=m' % name)
+        elif kind < 0.7:
+            lines.append('CONFIG_%s=y' % name)
+        elif kind < 0.9:
+            lines.append('# CONFIG_%s is not set' % name)
+        elif kind < 0.95:
+            lines.append('CONFIG_%s=%d' % (name, rng.randrange(1 << 16)))
+        else:
+            lines.append('CONFIG_%s="value %d"' % (name, rng.randrange(1000)))
+    return '\n'.join(lines) + '\n'
+
+
+def gen_changelog(rng, entries, source='linux-liquorix'):
+    ret = []
+    for i in range(entries):
+        # Ten revisions per upstream version, newest first
+        minor, revision = divmod(entries - 1 - i, 10)
+        ret.append('%s (6.%d-%d) unstable; urgency=medium\n\n' %
+                   (source, minor, revision + 1))
+        for j in range(rng.randrange(1, 8)):
+            ret.append('  * change %d of upload %d\n' % (j, i))
+            for k in range(rng.randrange(3)):
+                ret.append('   - detail %d\n' % k)
+        ret.append('\n -- Maintainer Name <maint@example.org>  '
+                   'Tue, 22 Oct 2024 09:57:57 -0500\n\n')
+    return ''.join(ret)
+
+
+def gen_relations(rng, count):
+    # Every package is listed twice on average, as when merging the
+    # relations of all flavours
+    ret = []
+    for i in range(count):
+        n = rng.randrange(count // 2 or 1)
+        entry = 'pkg%d (>= 1.%d)' % (n, n % 7)
+        if n % 3 == 0:
+            entry += ' [amd64 i386]'
+        if n % 5 == 0:
+            entry += ' | alt%d' % n
+        ret.append(entry)
+    return ret
+
+
+def gen_versions(rng, count):
+    # Kernel versions as uploaded: release candidates, stable updates,
+    # backports and binNMUs
+    ret = []
+    for i in range(count):
+        upstream = '%d.%d' % (rng.randrange(3, 7), rng.randrange(20))
+        kind = rng.random()
+        if kind < 0.2:
+            upstream += '~rc%d' % rng.randrange(1, 8)
+        elif kind < 0.8:
+            upstream += '.%d' % rng.randrange(200)
+        revision = '%d' % rng.randrange(1, 4)
+        kind = rng.random()
+        if kind < 0.2:
+            revision += '~bpo%d+1' % rng.randrange(9, 13)
+        elif kind < 0.3:
+            revision += '+b%d' % rng.randrange(1, 3)
+        if rng.random() < 0.05:
+            upstream = '1:' + upstream
+        ret.append('%s-%s' % (upstream, revision))
+    return ret
+
+
+# A copy of the packaging, with the flavours of amd64 replaced by the
+# given number of synthetic ones
+def gen_tree(rng, root, flavours, changelog_entries):
+    debian = os.path.join(root, 'debian')
+    for name in ('config', 'templates'):
+        shutil.copytree(os.path.join('debian', name),
+                        os.path.join(debian, name))
+    with open(os.path.join(debian, 'changelog'), 'w') as f:
+        f.write(gen_changelog(rng, changelog_entries))
+
+    names = ['flavour%03d' % i for i in range(flavours)]
+    flavour_list = ''.join(' %s\n' % i for i in names)
+    with open(os.path.join(debian, 'config/amd64/defines'), 'w') as f:
+        f.write('[base]\nfeaturesets:\n none\nflavours:\n%s'
+                'kernel-arch: x86\n\n' % flavour_list)
+        f.write('[build]\ndebug-info: false\n'
+                'image-file: arch/x86/boot/bzImage\n\n')
+        f.write('[image]\nbootloaders: grub-pc extlinux grub-efi-amd64\n'
+                'configs:\ninstall-stem: vmlinuz\nsuggests: crda\n\n')
+        for name in names:
+            f.write('[%s_description]\nhardware: machine %s\n'
+                    'hardware-long: machines of type %s\n\n' %
+                    (name, name, name))
+            f.write('[%s_image]\nconfigs:\n kernelarch-x86/config-arch-64\n'
+                    '\n' % name)
+    with open(os.path.join(debian, 'config/amd64/none/defines'), 'w') as f:
+        f.write('[base]\nflavours:\n%s' % flavour_list)
+    return debian
+
+
+def load_gencontrol():
+    spec = importlib.util.spec_from_file_location(
+        'gencontrol', 'debian/bin/gencontrol.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextlib.contextmanager
+def cwd(dir):
+    old = os.getcwd()
+    os.chdir(dir)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+
+# Every benchmark takes the random generator, the scale and a scratch
+# directory, prepares its data and returns the function to time, or None
+# if a tool it needs is missing
+def bench_kconfig_read(rng, scale, tmp):
+    text = gen_kconfig(rng, int(15000 * scale))
+
+    def run():
+        KconfigFile().read(io.StringIO(text))
+    return run
+
+
+def bench_kconfig_str(rng, scale, tmp):
+    kconfig = KconfigFile()
+    kconfig.read(io.StringIO(gen_kconfig(rng, int(15000 * scale))))
+
+    def run():
+        str(kconfig)
+    return run
+
+
+def bench_config_hierarchy(rng, scale, tmp):
+    gen_tree(rng, tmp, int(200 * scale), 10)
+    schema = load_gencontrol().Gencontrol.config_schema
+    dirs = [os.path.join(tmp, 'debian/config')]
+
+    def run():
+        ConfigCoreHierarchy(schema, dirs)
+    return run
+
+
+def bench_config_load(rng, scale, tmp):
+    gen_tree(rng, tmp, int(200 * scale), 10)
+    schema = load_gencontrol().Gencontrol.config_schema
+    f = io.BytesIO()
+    ConfigCoreHierarchy(schema, [os.path.join(tmp, 'debian/config')]).dump(f)
+    data = f.getvalue()
+
+    # Loading config.defines.dump to look at one flavour, as the build does
+    def run():
+        config = ConfigCoreDump(io.BytesIO(data))
+        for section in ('base', 'build', 'image'):
+            config.merge(section, 'amd64', 'none', 'flavour000')
+    return run
+
+
+def bench_changelog(rng, scale, tmp):
+    text = gen_changelog(rng, int(5000 * scale))
+
+    # Reading the entries of the current upstream version, as gencontrol.py
+    # does, and then counting all of them
+    def run():
+        changelog = Changelog(file=io.StringIO(text), version=VersionLinux)
+        upstream = changelog[0].version.upstream
+        for entry in changelog:
+            if entry.version.upstream != upstream:
+                break
+        len(changelog)
+    return run
+
+
+# Versions are cached by string, every run starts without them like a
+# new process
+def bench_version_sort(rng, scale, tmp):
+    versions = gen_versions(rng, int(5000 * scale))
+
+    def run():
+        Version._cache.clear()
+        sort_versions(versions)
+    return run
+
+
+# Comparing versions in Python and with one dpkg process per pair, as
+# scripts did before Version could compare
+def bench_version_compare(rng, scale, tmp):
+    pairs = list(zip(*[iter(gen_versions(rng, int(400 * scale)))] * 2))
+
+    def run():
+        Version._cache.clear()
+        for a, b in pairs:
+            Version(a) < Version(b)
+    return run
+
+
+def bench_version_compare_dpkg(rng, scale, tmp):
+    if shutil.which('dpkg') is None:
+        return None
+    pairs = list(zip(*[iter(gen_versions(rng, int(400 * scale)))] * 2))
+
+    def run():
+        for a, b in pairs:
+            subprocess.call(['dpkg', '--compare-versions', a, 'lt', b])
+    return run
+
+
+def bench_package_relation(rng, scale, tmp):
+    relations = gen_relations(rng, int(2000 * scale))
+
+    def run():
+        ret = PackageRelation()
+        for i in relations:
+            ret.extend(i)
+    return run
+
+
+# Writing the packages of many flavours, then writing them again after
+# changing one field of each, as when regenerating debian/control
+def bench_control_write(rng, scale, tmp):
+    templates = Templates()
+    gencontrol = Gencontrol(None, templates)
+    packages = []
+    for i in range(int(200 * scale)):
+        vars = {'abiname': '6.%d' % rng.randrange(20),
+                'localversion': '-flavour%03d' % i,
+                'class': 'machines of type %d' % i,
+                'longclass': 'machines of type %d' % i,
+                'version': '6.0', 'upstreamversion': '6.0'}
+        for name in ('control.image', 'control.headers'):
+            for package in templates[name]:
+                package = gencontrol.process_package(package, vars)
+                package['Architecture'] = 'amd64'
+                packages.append(package)
+
+    def run():
+        write_rfc822(io.StringIO(), packages)
+        for package in packages:
+            package['Architecture'].add('i386')
+        write_rfc822(io.StringIO(), packages)
+        for package in packages:
+            package['Architecture'].discard('i386')
+    return run
+
+
+def bench_gencontrol(rng, scale, tmp):
+    gen_tree(rng, tmp, int(50 * scale), int(500 * scale))
+    gencontrol = load_gencontrol()
+
+    def run():
+        with cwd(tmp):
+            gencontrol.Gencontrol()()
+    return run
+
+
+benchmarks = (
+    ('kconfig-read', bench_kconfig_read),
+    ('kconfig-str', bench_kconfig_str),
+    ('config-hierarchy', bench_config_hierarchy),
+    ('config-load', bench_config_load),
+    ('changelog', bench_changelog),
+    ('version-sort', bench_version_sort),
+    ('version-compare', bench_version_compare),
+    ('version-compare-dpkg', bench_version_compare_dpkg),
+    ('package-relation', bench_package_relation),
+    ('control-write', bench_control_write),
+    ('gencontrol', bench_gencontrol),
+)
+
+
+def measure(run, repeat):
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    # Tracing slows everything down, so peak memory gets its own run
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'best': min(times),
+        'median': statistics.median(times),
+        'peak': peak,
+    }
+
+
+def run_benchmarks(names, scale, repeat, seed):
+    ret = {}
+    for name, setup in benchmarks:
+        if names and name not in names:
+            continue
+        tmp = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            run = setup(random.Random(seed), scale, tmp)
+            if run is not None:
+                ret[name] = measure(run, repeat)
+        finally:
+            shutil.rmtree(tmp)
+        if run is None:
+            print('%-20s skipped' % name)
+        else:
+            report(name, ret[name])
+    return ret
+
+
+def report(name, result, base=None):
+    line = '%-20s %9.2f ms %9.2f ms %10d KiB' % (
+        name, result['best'] * 1000, result['median'] * 1000,
+        result['peak'] // 1024)
+    if base is not None:
+        line += '  %+6.1f%% time %+6.1f%% memory' % (
+            (result['best'] / base['best'] - 1) * 100,
+            (result['peak'] / (base['peak'] or 1) - 1) * 100)
+    print(line)
+    sys.stdout.flush()
+
+
+# Return the benchmarks that got slower than the baseline by more than
+# tolerance
+def compare(results, baseline, tolerance):
+    ret = []
+    print('\nCompared to the baseline:')
+    for name, result in results.items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        report(name, result, base)
+        if result['best'] > base['best'] * (1 + tolerance):
+            ret.append(name)
+    return ret
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage="%prog [OPTION]... [BENCHMARK]...",
+        description="Benchmarks: " + ', '.join(i[0] for i in benchmarks))
+    parser.add_option(
+        '-r', '--repeat',
+        default=5,
+        dest='repeat',
+        help="Time every benchmark N times (default: %default)",
+        metavar='N',
+        type='int')
+    parser.add_option(
+        '--scale',
+        default=1.0,
+        dest='scale',
+        help="Multiply the size of the generated data by FACTOR",
+        metavar='FACTOR',
+        type='float')
+    parser.add_option(
+        '--seed',
+        default=0,
+        dest='seed',
+        help="Seed of the data generators (default: %default)",
+        type='int')
+    parser.add_option(
+        '--save',
+        dest='save',
+        help="Write the results to FILE as JSON",
+        metavar='FILE')
+    parser.add_option(
+        '--compare',
+        dest='compare',
+        help="Compare the results with the JSON baseline in FILE, and fail "
+             "if a benchmark got slower by more than the tolerance",
+        metavar='FILE')
+    parser.add_option(
+        '--tolerance',
+        default=0.25,
+        dest='tolerance',
+        help="Allowed slowdown for --compare (default: %default)",
+        type='float')
+    options, args = parser.parse_args()
+
+    unknown = set(args) - set(i[0] for i in benchmarks)
+    if unknown:
+        parser.error('unknown benchmark %s' % ', '.join(sorted(unknown)))
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != version:
+            parser.error('baseline %s has version %s, expected %d' %
+                         (options.compare, baseline.get('version'), version))
+        for key in ('scale', 'seed'):
+            if baseline[key] != getattr(options, key):
+                sys.stderr.write('benchmark.py: warning: baseline %s differs '
+                                 '(%s)\n' % (key, baseline[key]))
+
+    print('%-20s %12s %12s %14s' % ('benchmark', 'best', 'median', 'peak'))
+    results = run_benchmarks(args, options.scale, options.repeat,
+                             options.seed)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'version': version,
+                'python': platform.python_version(),
+                'scale': options.scale,
+                'seed': options.seed,
+                'repeat': options.repeat,
+                'benchmarks': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if baseline is not None:
+        slower = compare(results, baseline, options.tolerance)
+        if slower:
+            sys.stderr.write('benchmark.py: slower than the baseline: %s\n' %
+                             ', '.join(slower))
+            sys.exit(1)
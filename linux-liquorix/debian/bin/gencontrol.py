@@ -3,18 +3,19 @@
 import sys
 sys.path.append("debian/lib/python")
 
-import codecs
 import errno
 import glob
 import io
 import os
 import os.path
+import shlex
 import subprocess
 
 from debian_linux import config
 from debian_linux.debian import *
-from debian_linux.gencontrol import Gencontrol as Base, merge_packages
-from debian_linux.utils import Templates, read_control
+from debian_linux.gencontrol import Gencontrol as Base, iter_arches, \
+    iter_arch_featuresets, iter_flavours, merge_packages
+from debian_linux.utils import Templates, Timings, read_control
 
 class Gencontrol(Base):
     config_schema = {
@@ -38,13 +39,23 @@ class Gencontrol(Base):
         },
     }
 
-    def __init__(self, config_dirs=["debian/config"], template_dirs=["debian/templates"]):
+    flavour_state = Base.flavour_state + ('kconfig_manifest', )
+
+    def __init__(self, config_dirs=["debian/config"], template_dirs=["debian/templates"],
+                 timings=None):
         super(Gencontrol, self).__init__(
-            config.ConfigCoreHierarchy(self.config_schema, config_dirs),
+            config.ConfigCoreHierarchy(
+                self.config_schema, config_dirs,
+                cache_dir=os.getenv('DEBIAN_KERNEL_CONFIG_CACHE'),
+                jobs=int(os.getenv('DEBIAN_KERNEL_CONFIG_JOBS', '1'))),
             Templates(template_dirs),
-            VersionLinux)
+            VersionLinux,
+            parallel=bool(os.getenv('DEBIAN_KERNEL_PARALLEL_RULES')),
+            jobs=int(os.getenv('DEBIAN_KERNEL_GENCONTROL_JOBS', '1')),
+            timings=timings)
         self.process_changelog()
         self.config_dirs = config_dirs
+        self.kconfig_manifest = {}
 
     def _setup_makeflags(self, names, makeflags, data):
         for src, dst, optional in names:
@@ -52,8 +63,10 @@ class Gencontrol(Base):
                 makeflags[dst] = data[src]
 
     def _substitute_file(self, template, vars, target, append=False):
-        with codecs.open(target, 'a' if append else 'w', 'utf-8') as f:
-            f.write(self.substitute(self.templates[template], vars))
+        data = self.substitute(self.templates[template], vars)
+        if append and target in self.files:
+            data = self.files[target][0] + data
+        self.files[target] = data, None
 
     def do_main_setup(self, vars, makeflags, extra):
         super(Gencontrol, self).do_main_setup(vars, makeflags, extra)
@@ -82,6 +95,12 @@ class Gencontrol(Base):
             makefile.add('source_%s' % featureset,
                          ['source_%s_real' % featureset])
             makefile.add('source', ['source_%s' % featureset])
+        # All featuresets are prepared from the same unpacked source
+        if makefile.parallel:
+            for prev, featureset in zip(fs_enabled, fs_enabled[1:]):
+                makefile.add('source_%s_real' % featureset,
+                             ['source_%s_real' % prev])
+            self.do_main_makefile_setup_order(makefile)
 
         triplet_enabled = []
         for arch in iter(self.config['base', ]['arches']):
@@ -99,6 +118,20 @@ class Gencontrol(Base):
         # linux-source-$UPSTREAMVERSION will contain all kconfig files
         makefile.add('binary-indep', deps=['setup'])
 
+    # Every setup merges the configs of all flavours in one kconfig.py
+    # batch, and the flavours of a featureset share its source, so all
+    # flavours are set up one after the other, each after its source
+    def do_main_makefile_setup_order(self, makefile):
+        order = []
+        for arch in iter_arches(self.config):
+            for featureset in iter_arch_featuresets(self.config, arch):
+                for flavour in iter_flavours(self.config, arch, featureset):
+                    setup = 'setup_%s_%s_%s_real' % (arch, featureset, flavour)
+                    if setup not in order:
+                        makefile.add(setup, order[-1:] +
+                                     ['source_%s_real' % featureset])
+                        order.append(setup)
+
     def do_main_packages(self, packages, vars, makeflags, extra):
         packages.extend(self.process_packages(self.templates["control.main"], self.vars))
 
@@ -395,8 +428,12 @@ class Gencontrol(Base):
         kconfig.extend(check_config("%s/%s/config" % (arch, featureset), False, arch, featureset))
         kconfig.extend(check_config("%s/%s/config.%s" % (arch, featureset, flavour), False, arch, featureset, flavour))
         makeflags['KCONFIG'] = ' '.join(kconfig)
+        kconfig_options = []
         if build_debug:
-            makeflags['KCONFIG_OPTIONS'] = '-o DEBUG_INFO=y'
+            kconfig_options = ['-o', 'DEBUG_INFO=y']
+            makeflags['KCONFIG_OPTIONS'] = ' '.join(kconfig_options)
+        self.kconfig_manifest['config.%s_%s_%s' % (arch, featureset, flavour)] = \
+            kconfig + kconfig_options
 
         cmds_binary_arch = ["$(MAKE) -f debian/rules.real binary-arch-flavour %s" % makeflags]
         if packages_dummy:
@@ -478,19 +515,37 @@ class Gencontrol(Base):
 
     def write(self, packages, makefile):
         self.write_config()
-        super(Gencontrol, self).write(packages, makefile)
+        self.write_kconfig_manifest()
         """
         self.write_tests_control()
         """
+        super(Gencontrol, self).write(packages, makefile)
 
     def write_config(self):
-        f = open("debian/config.defines.dump", 'wb')
+        f = io.BytesIO()
         self.config.dump(f)
-        f.close()
+        self.files["debian/config.defines.dump"] = f.getvalue(), None
+
+    def write_kconfig_manifest(self):
+        f = io.StringIO()
+        for output, args in sorted(self.kconfig_manifest.items()):
+            f.write(' '.join(shlex.quote(i) for i in [output] + args))
+            f.write('\n')
+        self.files["debian/kconfig.manifest"] = f.getvalue(), None
 
     def write_tests_control(self):
-        self.write_rfc822(codecs.open("debian/tests/control", 'w', 'utf-8'),
-                          [self.tests_control])
+        f = io.StringIO()
+        self.write_rfc822(f, [self.tests_control])
+        self.files["debian/tests/control"] = f.getvalue(), None
 
 if __name__ == '__main__':
-    Gencontrol()()
+    timings = None
+    if os.getenv('DEBIAN_KERNEL_GENCONTROL_TIMINGS'):
+        timings = Timings()
+    gencontrol = Gencontrol(timings=timings)
+    gencontrol()
+    for name in gencontrol.files_unchanged:
+        sys.stderr.write('gencontrol.py: %s: unchanged, not rewritten\n' %
+                         name)
+    if timings is not None:
+        timings.write(sys.stderr)
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import itertools
+import json
+import optparse
+import sys
+
+from debian_linux.kconfig import KconfigChange, KconfigFile
+
+
+def read(name):
+    kconfig = KconfigFile()
+    with open(name) as f:
+        kconfig.read(f)
+    return kconfig
+
+
+def write_text(out, old, new, changes):
+    out.write('--- %s\n+++ %s\n' % (old, new))
+    for change in changes:
+        out.write(str(change) + '\n')
+
+
+def write_json(out, old, new, changes):
+    json.dump({'old': old,
+               'new': new,
+               'changes': [change._asdict() for change in changes]},
+              out, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage="%prog [OPTION]... OLD NEW\n"
+              "       %prog [OPTION]... --all-pairs CONFIG...")
+    parser.add_option(
+        '--all-pairs',
+        action='store_true',
+        default=False,
+        dest='all_pairs',
+        help="Compare every pair of the given configs")
+    parser.add_option(
+        '--json',
+        action='store_const',
+        const=write_json,
+        default=write_text,
+        dest='write',
+        help="Write one JSON object per pair instead of text")
+    parser.add_option(
+        '-k', '--kind',
+        action='append',
+        choices=(KconfigChange.ADDED, KconfigChange.REMOVED,
+                 KconfigChange.TRISTATE, KconfigChange.VALUE),
+        dest='kinds',
+        help="Only report changes of KIND (added, removed, tristate, "
+             "value); may be repeated",
+        metavar='KIND')
+    options, args = parser.parse_args()
+
+    if options.all_pairs:
+        if len(args) < 2:
+            parser.error('--all-pairs needs at least two configs')
+        pairs = itertools.combinations(args, 2)
+    elif len(args) == 2:
+        pairs = [args]
+    else:
+        parser.error('need exactly two configs')
+
+    # Every config is read only once, however many pairs it is part of
+    configs = {}
+    for name in args:
+        if name not in configs:
+            configs[name] = read(name)
+
+    differ = False
+    for old, new in pairs:
+        changes = configs[old].diff(configs[new])
+        if options.kinds:
+            changes = (i for i in changes if i.kind in options.kinds)
+        changes = list(changes)
+        differ = differ or bool(changes)
+        options.write(sys.stdout, old, new, changes)
+
+    sys.exit(differ and 1 or 0)
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+import io
+import optparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+from debian_linux.kconfig import KconfigFile, read_manifest
+
+# Lines that set an option, to rewrite fragments without losing comments
+option_re = re.compile(r'^\s*(?:CONFIG_([^=\s]+)=|# CONFIG_(\S+) is not set)')
+
+
+class Fragments(dict):
+    def __missing__(self, name):
+        kconfig = self[name] = KconfigFile()
+        with open(name) as f:
+            kconfig.read(f)
+        return kconfig
+
+
+def merge(fragments, configs):
+    ret = KconfigFile()
+    for c in configs:
+        ret.update(fragments[c])
+    return ret
+
+
+# Options that every output sets to the same value in the layers after
+# target.  Setting them in target instead and dropping them from those
+# layers leaves every merged config unchanged.
+def common(fragments, entries, target):
+    after = []
+    for output, configs, overrides in entries:
+        if target not in configs:
+            raise RuntimeError('%s is not a layer of %s' % (target, output))
+        after.append(merge(fragments, configs[configs.index(target) + 1:]))
+    return after[0].intersection(*after[1:])
+
+
+def filter_lines(name, remove):
+    ret, removed = [], 0
+    with open(name) as f:
+        for line in f:
+            match = option_re.match(line)
+            if match and (match.group(1) or match.group(2)) in remove:
+                removed += 1
+            else:
+                ret.append(line)
+    return ret, removed
+
+
+def hoist(fragments, entries, target, shared):
+    later = []
+    for output, configs, overrides in entries:
+        for c in configs[configs.index(target) + 1:]:
+            if c not in later:
+                later.append(c)
+
+    files = {}
+    for name in later:
+        lines, removed = filter_lines(name, shared)
+        if removed:
+            files[name] = lines
+            sys.stderr.write('%s: %d options removed\n' % (name, removed))
+
+    lines, removed = filter_lines(target, shared)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.extend(i + '\n' for i in shared.str_iter())
+    files[target] = lines
+    sys.stderr.write('%s: %d options added\n' % (target, len(shared)))
+    return files
+
+
+def verify(entries, files):
+    # Merge every output from the rewritten fragments and compare
+    rewritten = Fragments()
+    for name, lines in files.items():
+        rewritten[name] = KconfigFile()
+        rewritten[name].read(io.StringIO(''.join(lines)))
+    original = Fragments()
+    for output, configs, overrides in entries:
+        for c in configs:
+            if c not in rewritten:
+                rewritten[c] = original[c]
+        if merge(original, configs).digest() != \
+           merge(rewritten, configs).digest():
+            raise RuntimeError('Hoisting would change %s' % output)
+
+
+class _FactorTest(unittest.TestCase):
+    files = {
+        'config': '# common\nCONFIG_A=y\n',
+        'config.a': '# flavour a\nCONFIG_B=m\nCONFIG_C=y\n'
+                    '# CONFIG_D is not set\n',
+        'config.b': 'CONFIG_C=y\nCONFIG_B=m\nCONFIG_D=y\n',
+        'config.rt': '# CONFIG_C is not set\n',
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, data in self.files.items():
+            with open(self.path(name), 'w') as f:
+                f.write(data)
+        self.target = self.path('config')
+        self.entries = [
+            ('a', [self.target, self.path('config.a')], {}),
+            ('b', [self.target, self.path('config.b')], {}),
+            ('b-rt', [self.target, self.path('config.b'),
+                      self.path('config.rt')], {}),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def digests(self):
+        fragments = Fragments()
+        return [merge(fragments, configs).digest()
+                for output, configs, overrides in self.entries]
+
+    def test_hoist(self):
+        digests = self.digests()
+        shared = common(Fragments(), self.entries, self.target)
+        self.assertEqual(list(shared.str_iter()), ['CONFIG_B=m'])
+        files = hoist(Fragments(), self.entries, self.target, shared)
+        verify(self.entries, files)
+        self.assertEqual(sorted(files),
+                         [self.path('config'), self.path('config.a'),
+                          self.path('config.b')])
+        self.assertEqual(''.join(files[self.path('config')]),
+                         '# common\nCONFIG_A=y\nCONFIG_B=m\n')
+        self.assertEqual(''.join(files[self.path('config.a')]),
+                         '# flavour a\nCONFIG_C=y\n'
+                         '# CONFIG_D is not set\n')
+        self.assertEqual(''.join(files[self.path('config.b')]),
+                         'CONFIG_C=y\nCONFIG_D=y\n')
+        for name, lines in files.items():
+            with open(name, 'w') as f:
+                f.writelines(lines)
+        self.assertEqual(self.digests(), digests)
+
+    def test_verify(self):
+        shared = common(Fragments(), self.entries, self.target)
+        files = hoist(Fragments(), self.entries, self.target, shared)
+        files[self.path('config.a')].append('CONFIG_E=y\n')
+        self.assertRaises(RuntimeError, verify, self.entries, files)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage="%prog [OPTION]... --into LAYER [MANIFEST]")
+    parser.add_option(
+        '--into',
+        dest='target',
+        help="Move options shared by all outputs into LAYER, e.g. "
+             "debian/config/config",
+        metavar='LAYER')
+    parser.add_option(
+        '-n', '--dry-run',
+        action='store_true',
+        default=False,
+        dest='dry_run',
+        help="Only list the options that would be moved")
+    options, args = parser.parse_args()
+
+    if not options.target:
+        parser.error('--into is required')
+    if len(args) > 1:
+        parser.error('too many arguments')
+
+    with open(args and args[0] or 'debian/kconfig.manifest') as f:
+        entries = list(read_manifest(f))
+    if not entries:
+        parser.error('empty manifest')
+
+    fragments = Fragments()
+    shared = common(fragments, entries, options.target)
+    if options.dry_run:
+        for i in shared.str_iter():
+            print(i)
+        sys.exit(0)
+
+    files = hoist(fragments, entries, options.target, shared)
+    verify(entries, files)
+    for name, lines in files.items():
+        with open(name, 'w') as f:
+            f.writelines(lines)
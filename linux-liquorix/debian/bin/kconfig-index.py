@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+import io
+import optparse
+import os
+import sys
+
+from debian_linux.kconfig import KconfigFile
+from debian_linux.kconfig_index import KconfigIndex
+from debian_linux.utils import update_file
+
+
+# The index is replaced atomically, as setups may read it meanwhile.  An
+# unchanged one is only touched, as make expects.
+def build(srctree, srcarch, output):
+    index = KconfigIndex.build(srctree, srcarch)
+    f = io.BytesIO()
+    index.dump(f)
+    if not update_file(output, f.getvalue()):
+        os.utime(output)
+
+
+def check(index_name, configs, strict):
+    with open(index_name, 'rb') as f:
+        index = KconfigIndex.load(f)
+    kconfig = KconfigFile()
+    for c in configs:
+        with open(c) as f:
+            kconfig.read(f)
+
+    errors = 0
+    for location in index.unresolved:
+        sys.stderr.write('%s: source not followed, index incomplete\n' %
+                         location)
+    for name in index.check_unknown(kconfig):
+        print('unknown: CONFIG_%s' % name)
+        errors += 1
+    for name, value, type in index.check_mistyped(kconfig):
+        print('mistyped: CONFIG_%s=%s (%s)' % (name, value, type))
+        errors += 1
+    for name in index.check_new(kconfig):
+        print('new: CONFIG_%s' % name)
+    return strict and errors and 1 or 0
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage="%prog build [--srcarch ARCH] SRCTREE INDEX\n"
+              "       %prog check [--strict] INDEX CONFIG...")
+    parser.add_option(
+        '--srcarch',
+        default='x86',
+        dest='srcarch',
+        help="Kernel architecture to index (default: %default)",
+        metavar='ARCH')
+    parser.add_option(
+        '--strict',
+        action='store_true',
+        default=False,
+        dest='strict',
+        help="Fail on unknown or mistyped symbols")
+    options, args = parser.parse_args()
+
+    if len(args) == 3 and args[0] == 'build':
+        build(args[1], options.srcarch, args[2])
+    elif len(args) >= 3 and args[0] == 'check':
+        sys.exit(check(args[1], args[2:], options.strict))
+    else:
+        parser.error('unknown command or wrong number of arguments')
@@ -1,18 +1,253 @@
 #!/usr/bin/python3
 
+import fcntl
+import hashlib
 import optparse
+import os
 import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
 
-from debian_linux.kconfig import KconfigFile
+from debian_linux import utils
+from debian_linux.kconfig import KconfigFile, read_manifest
 
 
-def merge(output, configs, overrides):
+# Content-addressed store of merged configs.  The key covers the content
+# of every input fragment, in order, and the overrides, so a hit can be
+# copied to the output without parsing anything.
+class MergeCache(object):
+    # Bump when the merge result for the same input or the format of the
+    # entries changes.  Version 2 entries have a .digest file.
+    version = 2
+
+    # Temporary files older than this are left over from interrupted runs
+    tmp_age = 3600
+
+    def __init__(self, dir, size_limit):
+        self.dir, self.size_limit = dir, size_limit
+
+    def key(self, configs, overrides):
+        h = hashlib.sha256(b'kconfig-merge %d\n' % self.version)
+        for c in configs:
+            with open(c, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        for key, value in sorted(overrides.items()):
+            h.update(('%s=%s\n' % (key, value)).encode('utf-8'))
+        return h.hexdigest()
+
+    # Every entry is the merged config and its digest
+    def _path(self, key, suffix='.config'):
+        return os.path.join(self.dir, key + suffix)
+
+    def get(self, key, output):
+        path = self._path(key)
+        try:
+            with open(self._path(key, '.digest')) as f:
+                digest = f.read()
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._count('misses')
+            return False
+        write_file(output, data)
+        utils.update_file(output + '.digest', digest)
+        # Entries are evicted least recently used first
+        os.utime(path)
+        self._count('hits')
+        return True
+
+    def put(self, key, output):
+        os.makedirs(self.dir, exist_ok=True)
+        # The config goes last, entries without it are ignored
+        for src, suffix in ((output + '.digest', '.digest'),
+                            (output, '.config')):
+            fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+            os.close(fd)
+            try:
+                shutil.copyfile(src, tmp)
+                os.replace(tmp, self._path(key, suffix))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.dir):
+            key, suffix = os.path.splitext(name)
+            try:
+                st = os.stat(os.path.join(self.dir, name))
+            except FileNotFoundError:
+                continue
+            if suffix == '.config':
+                entries.append((st.st_mtime, st.st_size, key))
+            elif suffix == '.tmp' and st.st_mtime < now - self.tmp_age:
+                try:
+                    os.unlink(os.path.join(self.dir, name))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        size = sum(i[1] for i in entries)
+        for mtime, entry_size, key in entries:
+            if size <= self.size_limit:
+                break
+            for suffix in ('.config', '.digest'):
+                try:
+                    os.unlink(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+            size -= entry_size
+        self._fold_counts()
+
+    # Every hit or miss appends a line to the counts file, under a shared
+    # lock.  Appends of a single short line don't mix, so concurrent runs
+    # lose no counts.  evict() folds the lines into totals under an
+    # exclusive lock, so the file doesn't keep growing.
+    def _count(self, what):
+        os.makedirs(self.dir, exist_ok=True)
+        fd = os.open(os.path.join(self.dir, 'counts'),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            os.write(fd, ('%s\n' % what).encode('ascii'))
+        finally:
+            os.close(fd)
+
+    def _fold_counts(self):
+        try:
+            f = open(os.path.join(self.dir, 'counts'), 'r+')
+        except FileNotFoundError:
+            return
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            counts = self._read_counts(f)
+            f.seek(0)
+            f.truncate()
+            f.write(''.join('%s %d\n' % i for i in counts.items()))
+
+    # Lines are either a single hit or miss, or a total of them
+    @staticmethod
+    def _read_counts(f):
+        ret = {'hits': 0, 'misses': 0}
+        for line in f:
+            what, _, count = line.partition(' ')
+            what = what.strip()
+            if what in ret:
+                ret[what] += int(count or 1)
+        return ret
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.dir, 'counts')) as f:
+                return self._read_counts(f)
+        except FileNotFoundError:
+            return self._read_counts([])
+
+
+def merge(output, configs, overrides, cache=None):
+    if cache is not None:
+        cache_key = cache.key(configs, overrides)
+        if cache.get(cache_key, output):
+            sys.stderr.write('kconfig.py: %s: cache hit (%s)\n' %
+                             (output, cache_key))
+            return
+        sys.stderr.write('kconfig.py: %s: cache miss (%s)\n' %
+                         (output, cache_key))
+
     kconfig = KconfigFile()
     for c in configs:
         kconfig.read(open(c))
     for key, value in overrides.items():
         kconfig.set(key, value)
-    open(output, "w").write(str(kconfig))
+    write(output, kconfig)
+
+    if cache is not None:
+        cache.put(cache_key, output)
+
+
+# Parsed fragments and merged prefixes of the fragment lists, shared
+# between all outputs of a batch so that common layers such as
+# debian/config/config are read and merged only once.
+class Layers(object):
+    def __init__(self):
+        self.fragments = {}
+        self.prefixes = {(): KconfigFile()}
+
+    def read(self, config):
+        try:
+            return self.fragments[config]
+        except KeyError:
+            kconfig = KconfigFile()
+            with open(config) as f:
+                kconfig.read(f)
+            self.fragments[config] = kconfig
+            return kconfig
+
+    def merge(self, configs):
+        configs = tuple(configs)
+        n = len(configs)
+        while configs[:n] not in self.prefixes:
+            n -= 1
+        kconfig = self.prefixes[configs[:n]]
+        for i in range(n, len(configs)):
+            kconfig = kconfig.copy()
+            kconfig.update(self.read(configs[i]))
+            self.prefixes[configs[:i + 1]] = kconfig
+        return kconfig.copy()
+
+
+def merge_batch(manifest, output_dir, force, cache=None):
+    force = set(os.path.normpath(i) for i in force)
+    layers = Layers()
+
+    for output, configs, overrides in read_manifest(manifest):
+        output = os.path.normpath(os.path.join(output_dir, output))
+        if output not in force and not outdated(output, configs):
+            continue
+
+        if cache is not None:
+            cache_key = cache.key(configs, overrides)
+            if cache.get(cache_key, output):
+                sys.stderr.write('kconfig.py: %s: cache hit (%s)\n' %
+                                 (output, cache_key))
+                continue
+            sys.stderr.write('kconfig.py: %s: cache miss (%s)\n' %
+                             (output, cache_key))
+
+        kconfig = layers.merge(configs)
+        for key, value in overrides.items():
+            kconfig.set(key, value)
+        write(output, kconfig)
+
+        if cache is not None:
+            cache.put(cache_key, output)
+
+
+# The merged config is always rewritten, as make expects.  Its digest
+# file is only touched if the options really changed, so the setup stage,
+# which depends on the digest, is skipped if only order or comments did.
+def write(output, kconfig):
+    write_file(output, str(kconfig))
+    utils.update_file(output + '.digest', kconfig.digest() + '\n')
+
+
+# Outputs are replaced atomically, as parallel batch runs may write the
+# same config while a setup reads it.  An unchanged one is only touched.
+def write_file(name, data):
+    if not utils.update_file(name, data):
+        os.utime(name)
+
+
+def outdated(output, configs):
+    try:
+        mtime = os.stat(output).st_mtime
+    except FileNotFoundError:
+        return True
+    return any(os.stat(c).st_mtime > mtime for c in configs)
 
 
 def opt_callback_dict(option, opt, value, parser):
@@ -24,8 +259,96 @@ def opt_callback_dict(option, opt, value, parser):
     data[match.group(1)] = match.group(2)
 
 
+class _MergeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fragment = os.path.join(self.dir, 'config')
+        with open(self.fragment, 'w') as f:
+            f.write('CONFIG_A=y\n# CONFIG_B is not set\n')
+        self.cache = MergeCache(os.path.join(self.dir, 'cache'), 1 << 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    def test_hit(self):
+        merge(os.path.join(self.dir, 'a'), [self.fragment], {'C': 'm'},
+              self.cache)
+        merge(os.path.join(self.dir, 'b'), [self.fragment], {'C': 'm'},
+              self.cache)
+        merge(os.path.join(self.dir, 'c'), [self.fragment], {}, self.cache)
+        self.assertEqual(self.read('a'), self.read('b'))
+        self.assertEqual(self.read('a.digest'), self.read('b.digest'))
+        self.assertNotEqual(self.read('a'), self.read('c'))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+        # Eviction folds the counts into totals
+        self.cache.evict()
+        self.assertEqual(self.read('cache/counts'), 'hits 1\nmisses 2\n')
+        merge(os.path.join(self.dir, 'd'), [self.fragment], {}, self.cache)
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 2})
+
+    def test_digest(self):
+        output = os.path.join(self.dir, 'a')
+        merge(output, [self.fragment], {})
+        os.utime(output + '.digest', (0, 0))
+        # Only the order changes, so the digest is left alone
+        with open(self.fragment, 'w') as f:
+            f.write('# CONFIG_B is not set\nCONFIG_A=y\n')
+        merge(output, [self.fragment], {})
+        self.assertEqual(os.stat(output + '.digest').st_mtime, 0)
+        with open(self.fragment, 'w') as f:
+            f.write('CONFIG_A=m\n')
+        merge(output, [self.fragment], {})
+        self.assertNotEqual(os.stat(output + '.digest').st_mtime, 0)
+
+    def test_evict(self):
+        merge(os.path.join(self.dir, 'a'), [self.fragment], {}, self.cache)
+        tmp = os.path.join(self.cache.dir, 'stale.tmp')
+        fresh = os.path.join(self.cache.dir, 'fresh.tmp')
+        for name in tmp, fresh:
+            open(name, 'w').close()
+        os.utime(tmp, (0, 0))
+        self.cache.size_limit = 0
+        self.cache.evict()
+        self.assertEqual(sorted(os.listdir(self.cache.dir)),
+                         ['counts', 'fresh.tmp'])
+
+    def test_batch(self):
+        other = os.path.join(self.dir, 'other')
+        with open(other, 'w') as f:
+            f.write('CONFIG_B=m\nCONFIG_D="x y"\n')
+        manifest = [
+            ('a', [self.fragment], {}),
+            ('b', [self.fragment, other], {}),
+            ('c', [self.fragment, other], {'A': 'n', 'E': '1'}),
+        ]
+        batch = os.path.join(self.dir, 'batch')
+        os.mkdir(batch)
+        lines = []
+        for output, configs, overrides in manifest:
+            merge(os.path.join(self.dir, output), configs, overrides)
+            lines.append(' '.join([output] + configs + [
+                '-o %s=%s' % i for i in overrides.items()]) + '\n')
+        merge_batch(lines, batch, [], self.cache)
+        for output, configs, overrides in manifest:
+            for suffix in '', '.digest':
+                self.assertEqual(
+                    self.read(os.path.join('batch', output + suffix)),
+                    self.read(output + suffix))
+        # Outputs newer than their fragments are left alone, unless forced
+        for name in self.fragment, other:
+            os.utime(name, (0, 0))
+        merge_batch(lines, batch, [os.path.join(batch, 'b')], self.cache)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 3})
+
+
 if __name__ == '__main__':
-    parser = optparse.OptionParser(usage="%prog [OPTION]... FILE...")
+    parser = optparse.OptionParser(
+        usage="%prog [OPTION]... FILE...\n"
+              "       %prog [OPTION]... --batch MANIFEST [OUTPUT]...")
     parser.add_option(
         '-o', '--override',
         action='callback',
@@ -34,6 +357,54 @@ if __name__ == '__main__':
         dest='overrides',
         help="Override option",
         type='string')
+    parser.add_option(
+        '--batch',
+        dest='batch',
+        help="Write every config listed in MANIFEST that is missing or older "
+             "than its fragments, and any OUTPUT given as argument",
+        metavar='MANIFEST')
+    parser.add_option(
+        '--output-dir',
+        default='.',
+        dest='output_dir',
+        help="Directory for the outputs of --batch (default: %default)",
+        metavar='DIR')
+    parser.add_option(
+        '--cache-dir',
+        default=os.getenv('DEBIAN_KERNEL_KCONFIG_CACHE'),
+        dest='cache_dir',
+        help="Cache merged configs in DIR "
+             "(default: $DEBIAN_KERNEL_KCONFIG_CACHE)",
+        metavar='DIR')
+    parser.add_option(
+        '--cache-size',
+        default=64 << 20,
+        dest='cache_size',
+        help="Evict cached configs above SIZE bytes (default: %default)",
+        metavar='SIZE',
+        type='int')
+    parser.add_option(
+        '--cache-stats',
+        action='store_true',
+        default=False,
+        dest='cache_stats',
+        help="Report cache hits and misses and exit")
     options, args = parser.parse_args()
 
-    merge(args[0], args[1:], options.overrides)
+    cache = None
+    if options.cache_dir:
+        cache = MergeCache(options.cache_dir, options.cache_size)
+
+    if options.cache_stats:
+        if cache is None:
+            parser.error('--cache-stats requires a cache directory')
+        stats = cache.stats()
+        print('hits: %d' % stats['hits'])
+        print('misses: %d' % stats['misses'])
+        sys.exit(0)
+
+    if options.batch:
+        with open(options.batch) as f:
+            merge_batch(f, options.output_dir, args, cache)
+    else:
+        merge(args[0], args[1:], options.overrides, cache)
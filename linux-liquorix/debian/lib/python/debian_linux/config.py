@@ -1,9 +1,18 @@
 import collections
+import collections.abc
+import concurrent.futures
+import hashlib
+import io
 import os
 import os.path
 import pickle
 import re
+import shutil
+import struct
 import sys
+import tempfile
+import types
+import unittest
 
 from configparser import RawConfigParser
 
@@ -40,59 +49,355 @@ class SchemaItemList(object):
         return [j.strip() for j in re.split(self.type, i)]
 
 
-# Using OrderedDict instead of dict makes the pickled config reproducible
+# dump() writes the sections in the order of the config, so keeping it in
+# an OrderedDict makes the dump reproducible
 class ConfigCore(collections.OrderedDict):
-    def get_merge(self, section, arch, featureset, flavour, key, default=None):
-        temp = []
-
-        if arch and featureset and flavour:
-            temp.append(self.get((section, arch, featureset, flavour), {})
-                        .get(key))
-            temp.append(self.get((section, arch, None, flavour), {}).get(key))
-        if arch and featureset:
-            temp.append(self.get((section, arch, featureset), {}).get(key))
-        if arch:
-            temp.append(self.get((section, arch), {}).get(key))
+    # merge() and get_merge() are answered from an index of flattened
+    # sections.  The first query for a section of an (arch, featureset,
+    # flavour) chain resolves that section for the chain; the index is
+    # dropped on the next change of an entry.  Sections changed in place
+    # are not noticed, so they must be assigned back.  The index is not
+    # pickled.  Results are still copies that callers may change, as they
+    # always were; a copy of a flattened section is cheap next to
+    # resolving it.
+    def __init__(self, *args, **kwargs):
+        self._index = {}
+        super(ConfigCore, self).__init__(*args, **kwargs)
+
+    def __reduce__(self):
+        ret = list(super(ConfigCore, self).__reduce__())
+        state = dict(ret[2] or {})
+        state.pop('_index', None)
+        ret[2] = state or None
+        return tuple(ret)
+
+    def __setitem__(self, key, value):
+        self._invalidate()
+        super(ConfigCore, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._invalidate()
+        super(ConfigCore, self).__delitem__(key)
+
+    def _invalidate(self):
+        # Unpickled instances start without an index
+        self.__dict__['_index'] = {}
+
+    # The entries of a section that apply to a chain, least specific first
+    @staticmethod
+    def _layers(section, arch, featureset, flavour):
+        ret = [(section,)]
         if featureset:
-            temp.append(self.get((section, None, featureset), {}).get(key))
-        temp.append(self.get((section,), {}).get(key))
-
-        ret = []
+            ret.append((section, None, featureset))
+        if arch:
+            ret.append((section, arch))
+            if featureset:
+                ret.append((section, arch, featureset))
+                if flavour:
+                    ret.append((section, arch, None, flavour))
+                    ret.append((section, arch, featureset, flavour))
+        return ret
 
-        for i in temp:
-            if i is None:
+    # Return (values, lists, mixed) for a section of a chain.  values
+    # holds the most specific value of every key, lists the lists of every
+    # key whose most specific value is a list, concatenated over all
+    # layers, most specific first.  mixed maps the keys with a list set
+    # over a value in a less specific layer to that list's layer; a value
+    # set over a list simply wins.
+    def _flatten(self, section, arch, featureset, flavour):
+        values, lists, mixed = {}, {}, {}
+        for layer in self._layers(section, arch, featureset, flavour):
+            data = self.get(layer)
+            if not data:
                 continue
-            elif isinstance(i, (list, tuple)):
-                ret.extend(i)
-            elif ret:
-                # TODO
-                return ret
-            else:
-                return i
+            for key, value in data.items():
+                if isinstance(value, (list, tuple)):
+                    if key in values and key not in lists:
+                        mixed.setdefault(key, layer)
+                    lists[key] = tuple(value) + lists.get(key, ())
+                else:
+                    lists.pop(key, None)
+                values[key] = value
+        return values, lists, mixed
+
+    def _resolve(self, section, arch, featureset, flavour):
+        # Chains that only differ in ignored parts share an entry
+        arch, featureset = arch or None, featureset or None
+        key = section, arch, featureset, arch and featureset and flavour or None
+        try:
+            index = self._index
+        except AttributeError:
+            self._invalidate()
+            index = self._index
+        ret = index.get(key)
+        if ret is None:
+            ret = index[key] = self._flatten(*key)
+        return ret
 
-        return ret or default
+    def clear(self):
+        self._invalidate()
+        super(ConfigCore, self).clear()
 
+    # The value of key, with lists of all layers concatenated, most
+    # specific first
+    def get_merge(self, section, arch, featureset, flavour, key, default=None):
+        values, lists, mixed = self._resolve(section, arch, featureset,
+                                             flavour)
+        if key in mixed:
+            raise RuntimeError('Config %s mixes lists and values for %s' %
+                               (mixed[key], key))
+        if key in lists:
+            return list(lists[key]) or default
+        return values.get(key, default)
+
+    # All values of a section, the most specific ones winning
     def merge(self, section, arch=None, featureset=None, flavour=None):
-        ret = {}
-        ret.update(self.get((section,), {}))
-        if featureset:
-            ret.update(self.get((section, None, featureset), {}))
-        if arch:
-            ret.update(self.get((section, arch), {}))
-        if arch and featureset:
-            ret.update(self.get((section, arch, featureset), {}))
-        if arch and featureset and flavour:
-            ret.update(self.get((section, arch, None, flavour), {}))
-            ret.update(self.get((section, arch, featureset, flavour), {}))
-        return ret
+        return dict(self._resolve(section, arch, featureset, flavour)[0])
+
+    def pop(self, *args):
+        self._invalidate()
+        return super(ConfigCore, self).pop(*args)
+
+    def popitem(self, *args, **kwargs):
+        self._invalidate()
+        return super(ConfigCore, self).popitem(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._invalidate()
+        return super(ConfigCore, self).setdefault(key, default)
 
     def dump(self, fp):
-        pickle.dump(self, fp, 0)
+        _DumpWriter().write(self, fp)
+
+
+# A config as loaded from a dump, every section is decoded on first access
+class _ConfigCoreLazy(ConfigCore):
+    def __getitem__(self, key):
+        value = super(_ConfigCoreLazy, self).__getitem__(key)
+        if isinstance(value, _Encoded):
+            value = value.decode()
+            # Not a change, so the merge cache stays valid
+            collections.OrderedDict.__setitem__(self, key, value)
+        return value
+
+    def __eq__(self, other):
+        self._decode_all()
+        return super(_ConfigCoreLazy, self).__eq__(other)
+
+    def __reduce__(self):
+        self._decode_all()
+        return super(_ConfigCoreLazy, self).__reduce__()
+
+    def __repr__(self):
+        self._decode_all()
+        return super(_ConfigCoreLazy, self).__repr__()
+
+    def _decode_all(self):
+        for key in self:
+            self[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return collections.abc.ItemsView(self)
+
+    def pop(self, key, *args):
+        if key in self:
+            self[key]
+        return super(_ConfigCoreLazy, self).pop(key, *args)
+
+    def popitem(self, last=True):
+        key = next(reversed(self) if last else iter(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        return super(_ConfigCoreLazy, self).setdefault(key, default)
+
+    def values(self):
+        return collections.abc.ValuesView(self)
 
 
 class ConfigCoreDump(object):
     def __new__(self, fp):
-        return pickle.load(fp)
+        magic = fp.read(len(_DumpWriter.magic))
+        if magic != _DumpWriter.magic:
+            # Dumps written before the binary format
+            return pickle.loads(magic + fp.read())
+        return _DumpReader(magic + fp.read()).read()
+
+
+# The format of config.defines.dump, all numbers little endian:
+#   magic, u16 version
+#   u32 size and the string table: every string once, in order of first
+#     use, UTF-8 encoded and separated by NUL
+#   u32 number of sections, then for each its key as four i32 string
+#     numbers, -1 for None and -2 past the end of shorter keys, and the
+#     u32 size of its data
+#   the data of every section
+# Data is encoded as values: a type byte, then a u32 string number for
+# S, an i64 for I, a u32 count and that many string numbers for A (list
+# of strings), a u32 count and the items for L (list) and U (tuple), a
+# u32 count and the key and value pairs for D; N (None), T (True) and F
+# (False) have no payload.
+# The output only depends on the content and order of the config, so it
+# is reproducible.
+class _DumpWriter(object):
+    magic = b'DLCD'
+    version = 1
+
+    _index = struct.Struct('<iiiiI')
+
+    def __init__(self):
+        self.strings = {}
+
+    def write(self, config, fp):
+        index, sections = bytearray(), []
+        for key, section in config.items():
+            if len(key) > 4:
+                raise ValueError("Can't dump key %r" % (key, ))
+            key = [i is None and -1 or self.string(i) for i in key]
+            key += [-2] * (4 - len(key))
+            data = bytearray()
+            self.value(data, section)
+            index += self._index.pack(*key, len(data))
+            sections.append(data)
+
+        strings = '\0'.join(self.strings).encode('utf-8')
+        fp.write(self.magic + struct.pack('<HI', self.version, len(strings)))
+        fp.write(strings)
+        fp.write(struct.pack('<I', len(sections)))
+        fp.write(index)
+        for data in sections:
+            fp.write(data)
+
+    def string(self, value):
+        ret = self.strings.get(value)
+        if ret is None:
+            if '\0' in value:
+                raise ValueError("Can't dump string with NUL: %r" % value)
+            ret = self.strings[value] = len(self.strings)
+        return ret
+
+    def value(self, out, value):
+        if value is None:
+            out += b'N'
+        elif value is True:
+            out += b'T'
+        elif value is False:
+            out += b'F'
+        elif isinstance(value, int):
+            out += b'I' + struct.pack('<q', value)
+        elif isinstance(value, str):
+            out += b'S' + struct.pack('<I', self.string(value))
+        elif isinstance(value, list) and \
+                all(isinstance(i, str) for i in value):
+            out += b'A' + struct.pack('<I%dI' % len(value), len(value),
+                                      *(self.string(i) for i in value))
+        elif isinstance(value, (list, tuple)):
+            out += (isinstance(value, list) and b'L' or b'U') + \
+                struct.pack('<I', len(value))
+            for i in value:
+                self.value(out, i)
+        elif isinstance(value, dict):
+            out += b'D' + struct.pack('<I', len(value))
+            for k, v in value.items():
+                self.value(out, k)
+                self.value(out, v)
+        else:
+            raise TypeError("Can't dump %r" % (value, ))
+
+
+class _DumpReader(object):
+    __slots__ = 'data', 'strings'
+
+    _u32 = struct.Struct('<I')
+    _i64 = struct.Struct('<q')
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        data = self.data
+        version, size = struct.unpack_from('<HI', data, 4)
+        if version != _DumpWriter.version:
+            raise RuntimeError('Unsupported config dump version %d' %
+                               version)
+        pos = 10 + size
+        strings = self.strings = data[10:pos].decode('utf-8').split('\0')
+        count, = self._u32.unpack_from(data, pos)
+        pos += 4
+        end = pos + count * _DumpWriter._index.size
+        index = _DumpWriter._index.iter_unpack(data[pos:end])
+        pos = end
+
+        ret = _ConfigCoreLazy()
+        # -1 stands for None in keys
+        strings.append(None)
+        setitem = collections.OrderedDict.__setitem__
+        for a, b, c, d, size in index:
+            if d != -2:
+                key = strings[a], strings[b], strings[c], strings[d]
+            elif c != -2:
+                key = strings[a], strings[b], strings[c]
+            elif b != -2:
+                key = strings[a], strings[b]
+            else:
+                key = strings[a],
+            setitem(ret, key, _Encoded(self, pos))
+            pos += size
+        return ret
+
+    def value(self, pos):
+        data, strings = self.data, self.strings
+        tag = data[pos]
+        pos += 1
+        if tag == 0x53:     # S
+            return strings[self._u32.unpack_from(data, pos)[0]], pos + 4
+        if tag == 0x4e:     # N
+            return None, pos
+        if tag == 0x54:     # T
+            return True, pos
+        if tag == 0x46:     # F
+            return False, pos
+        if tag == 0x49:     # I
+            return self._i64.unpack_from(data, pos)[0], pos + 8
+        count, = self._u32.unpack_from(data, pos)
+        pos += 4
+        if tag == 0x41:     # A
+            end = pos + 4 * count
+            return [strings[i] for i in
+                    struct.unpack_from('<%dI' % count, data, pos)], end
+        if tag == 0x44:     # D
+            ret = {}
+            for i in range(count):
+                key, pos = self.value(pos)
+                ret[key], pos = self.value(pos)
+            return ret, pos
+        ret = []
+        for i in range(count):
+            item, pos = self.value(pos)
+            ret.append(item)
+        if tag == 0x55:     # U
+            return tuple(ret), pos
+        if tag != 0x4c:     # L
+            raise RuntimeError('Invalid config dump')
+        return ret, pos
+
+
+class _Encoded(object):
+    __slots__ = 'reader', 'pos'
+
+    def __init__(self, reader, pos):
+        self.reader, self.pos = reader, pos
+
+    def decode(self):
+        return self.reader.value(self.pos)[0]
 
 
 class ConfigCoreHierarchy(object):
@@ -105,33 +410,64 @@ class ConfigCoreHierarchy(object):
         },
     }
 
-    def __new__(cls, schema, dirs=[]):
+    def __new__(cls, schema, dirs=[], cache_dir=None, jobs=1):
         schema_complete = cls.schema_base.copy()
         for key, value in schema.items():
             schema_complete.setdefault(key, {}).update(value)
-        return cls.Reader(dirs, schema_complete)()
+        reader = cls.Reader(dirs, schema_complete, jobs)
+        if cache_dir is None:
+            return reader()
+
+        cache = _HierarchyCache(cache_dir)
+        key = cache.key(reader)
+        ret = cache.get(key)
+        if ret is None:
+            ret = reader()
+            cache.put(key, ret, reader.files)
+        return ret
 
     class Reader(object):
         config_name = "defines"
 
-        def __init__(self, dirs, schema):
-            self.dirs, self.schema = dirs, schema
+        def __init__(self, dirs, schema, jobs=1):
+            self.dirs, self.schema, self.jobs = dirs, schema, jobs
+            # Every file looked at, including missing ones
+            self.files = []
+            self.executor = None
 
         def __call__(self):
             ret = ConfigCore()
-            self.read(ret)
+            if self.jobs > 1:
+                with concurrent.futures.ProcessPoolExecutor(
+                        self.jobs) as self.executor:
+                    self.read(ret)
+                self.executor = None
+            else:
+                self.read(ret)
             return ret
 
         def get_files(self, *dirs):
             dirs = list(dirs)
             dirs.append(self.config_name)
-            return (os.path.join(i, *dirs) for i in self.dirs if i)
+            ret = [os.path.join(i, *dirs) for i in self.dirs if i]
+            self.files.extend(ret)
+            return ret
 
-        def read_arch(self, ret, arch):
-            config = ConfigParser(self.schema)
-            config.read(self.get_files(arch))
+        # Parse the defines files in dirs, in the pool if there is one.
+        # Only parsing is done in parallel, the results are merged in a
+        # fixed order, so the config is the same as from a serial read.
+        def parse(self, *dirs):
+            files = self.get_files(*dirs)
+            if self.executor is not None:
+                return self.executor.submit(_parse_defines, self.schema,
+                                            files)
+            ret = concurrent.futures.Future()
+            ret.set_result(_parse_defines(self.schema, files))
+            return ret
 
-            featuresets = config['base', ].get('featuresets', [])
+        def read_arch(self, ret, arch, config, featureset_configs):
+            # Copied, as it is modified below
+            featuresets = list(config['base', ].get('featuresets', []))
             flavours = config['base', ].get('flavours', [])
 
             for section in iter(config):
@@ -145,8 +481,9 @@ class ConfigCoreHierarchy(object):
                 s.update(config[section])
                 ret[tuple(real)] = s
 
-            for featureset in featuresets:
-                self.read_arch_featureset(ret, arch, featureset)
+            for featureset, future in featureset_configs:
+                self.read_arch_featureset(ret, arch, featureset,
+                                          future.result())
 
             if flavours:
                 base = ret['base', arch]
@@ -157,10 +494,7 @@ class ConfigCoreHierarchy(object):
                 ret['base', arch, 'none'] = {'flavours': flavours,
                                              'implicit-flavour': True}
 
-        def read_arch_featureset(self, ret, arch, featureset):
-            config = ConfigParser(self.schema)
-            config.read(self.get_files(arch, featureset))
-
+        def read_arch_featureset(self, ret, arch, featureset, config):
             for section in iter(config):
                 real = (section[-1], arch, featureset) + section[:-1]
                 s = ret.get(real, {})
@@ -168,8 +502,7 @@ class ConfigCoreHierarchy(object):
                 ret[tuple(real)] = s
 
         def read(self, ret):
-            config = ConfigParser(self.schema)
-            config.read(self.get_files())
+            config = self.parse().result()
 
             arches = config['base', ]['arches']
             featuresets = config['base', ].get('featuresets', [])
@@ -179,17 +512,27 @@ class ConfigCoreHierarchy(object):
                     real = (section[-1], None, section[0][11:])
                 else:
                     real = (section[-1],) + section[1:]
-                ret[real] = config[section]
-
-            for arch in arches:
-                self.read_arch(ret, arch)
-            for featureset in featuresets:
-                self.read_featureset(ret, featureset)
-
-        def read_featureset(self, ret, featureset):
-            config = ConfigParser(self.schema)
-            config.read(self.get_files('featureset-%s' % featureset))
-
+                ret[real] = dict(config[section])
+
+            # Start parsing every arch and featureset, and the featuresets
+            # of every arch as soon as the arch's featuresets are known
+            arch_configs = [(arch, self.parse(arch)) for arch in arches]
+            featureset_configs = [
+                (featureset, self.parse('featureset-%s' % featureset))
+                for featureset in featuresets]
+            for i, (arch, future) in enumerate(arch_configs):
+                config = future.result()
+                arch_configs[i] = arch, config, [
+                    (featureset, self.parse(arch, featureset))
+                    for featureset in
+                    config['base', ].get('featuresets', [])]
+
+            for arch, config, arch_featureset_configs in arch_configs:
+                self.read_arch(ret, arch, config, arch_featureset_configs)
+            for featureset, future in featureset_configs:
+                self.read_featureset(ret, featureset, future.result())
+
+        def read_featureset(self, ret, featureset, config):
             for section in iter(config):
                 real = (section[-1], None, featureset)
                 s = ret.get(real, {})
@@ -197,13 +540,86 @@ class ConfigCoreHierarchy(object):
                 ret[real] = s
 
 
+# The converted sections of a set of defines files, as plain data so that
+# it can be returned from a worker process
+def _parse_defines(schema, files):
+    config = ConfigParser(schema)
+    config.read(files)
+    return {section: dict(config[section]) for section in config}
+
+
+# Built configs, stored in the dump format.  An entry is found by the
+# schema and the config directories, and only used if every defines file
+# the Reader looked at still has the same content, and the missing ones
+# are still missing.  As the files looked at only depend on the content
+# of the earlier ones, the Reader would then build the same config.
+class _HierarchyCache(object):
+    # Bump when the config built from the same files changes
+    version = 1
+
+    def __init__(self, dir):
+        self.dir = dir
+
+    def key(self, reader):
+        h = hashlib.sha256(b'config-hierarchy %d\n' % self.version)
+        h.update(('%s\n%r\n' % (reader.config_name, reader.dirs))
+                 .encode('utf-8'))
+        for section, items in sorted(reader.schema.items()):
+            for key, item in sorted(items.items()):
+                h.update(('%s %s %s %r\n' % (
+                    section, key, item.__class__.__name__,
+                    sorted(vars(item).items()))).encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def _hash(name):
+        try:
+            with open(name, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return 'missing'
+
+    # Every entry is a line with the hash and name of every file, an empty
+    # line and the dump
+    def get(self, key):
+        try:
+            f = open(os.path.join(self.dir, key + '.defines'), 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            for line in f:
+                line = line.decode('utf-8').rstrip('\n')
+                if not line:
+                    return ConfigCoreDump(f)
+                digest, name = line.split(' ', 1)
+                if self._hash(name) != digest:
+                    return None
+        return None
+
+    def put(self, key, config, files):
+        os.makedirs(self.dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for name in collections.OrderedDict.fromkeys(files):
+                    f.write(('%s %s\n' % (self._hash(name), name))
+                            .encode('utf-8'))
+                f.write(b'\n')
+                config.dump(f)
+            os.replace(tmp, os.path.join(self.dir, key + '.defines'))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
 class ConfigParser(object):
-    __slots__ = '_config', 'schemas'
+    __slots__ = '_config', '_converted', 'schemas'
 
     def __init__(self, schemas):
         self.schemas = schemas
 
         self._config = RawConfigParser()
+        self._converted = None
 
     def __getitem__(self, key):
         return self._convert()[key]
@@ -212,9 +628,17 @@ class ConfigParser(object):
         return iter(self._convert())
 
     def __str__(self):
-        return '<%s(%s)>' % (self.__class__.__name__, self._convert())
+        return '<%s(%s)>' % (self.__class__.__name__,
+                             {k: dict(v) for k, v in self._convert().items()})
 
+    # The converted sections are built once and shared by every access
+    # until read() adds files, so they are only handed out read-only
     def _convert(self):
+        if self._converted is None:
+            self._converted = types.MappingProxyType(self._convert_all())
+        return self._converted
+
+    def _convert_all(self):
         ret = {}
         for section in self._config.sections():
             data = {}
@@ -227,7 +651,7 @@ class ConfigParser(object):
                 data = self._convert_one(self.schemas[section_base], data)
             else:
                 section_ret = (section, )
-            ret[section_ret] = data
+            ret[section_ret] = types.MappingProxyType(data)
         return ret
 
     def _convert_one(self, schema, data):
@@ -242,9 +666,217 @@ class ConfigParser(object):
         return self._convert().keys()
 
     def read(self, data):
+        self._converted = None
         return self._config.read(data)
 
 
+class _ConfigCoreTest(unittest.TestCase):
+    def setUp(self):
+        self.config = ConfigCore()
+        self.config['base', ] = {'a': 1, 'l': ['x']}
+        self.config['base', 'amd64'] = {'a': 2, 'l': ['y']}
+        self.config['base', 'amd64', 'none', 'f'] = {'b': 3}
+        self.config['other', ] = {'m': ['x']}
+        self.config['other', 'amd64'] = {'m': 'value'}
+
+    def test_merge(self):
+        self.assertEqual(self.config.merge('base'), {'a': 1, 'l': ['x']})
+        self.assertEqual(self.config.merge('base', 'amd64', 'none', 'f'),
+                         {'a': 2, 'b': 3, 'l': ['y']})
+        self.assertEqual(self.config.merge('missing', 'amd64'), {})
+
+    def test_merge_copy(self):
+        merged = self.config.merge('base', 'amd64')
+        merged['a'] = 5
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 2)
+
+    def test_get_merge(self):
+        get_merge = self.config.get_merge
+        self.assertEqual(get_merge('base', 'amd64', None, None, 'l'),
+                         ['y', 'x'])
+        self.assertEqual(get_merge('base', 'amd64', 'none', 'f', 'a'), 2)
+        self.assertEqual(get_merge('base', None, None, None, 'c', 0), 0)
+        ret = get_merge('base', 'amd64', None, None, 'l')
+        ret.append('z')
+        self.assertEqual(get_merge('base', 'amd64', None, None, 'l'),
+                         ['y', 'x'])
+
+    def test_mixed(self):
+        # A value over a list wins, only a list over a value fails
+        self.assertEqual(self.config.merge('other', 'amd64'), {'m': 'value'})
+        self.assertEqual(self.config.get_merge('other', 'amd64', None, None,
+                                               'm'), 'value')
+        self.config['other', 'amd64', 'none'] = {'m': ['y']}
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 2)
+        self.assertRaises(RuntimeError, self.config.get_merge,
+                          'other', 'amd64', 'none', None, 'm')
+
+    def test_invalidate(self):
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 2)
+        self.config['base', 'amd64'] = {'a': 4}
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 4)
+        del self.config['base', 'amd64']
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 1)
+        self.config.setdefault(('base', 'amd64'), {'a': 6})
+        self.assertEqual(self.config.merge('base', 'amd64')['a'], 6)
+        self.config.pop(('base', 'amd64'))
+        self.assertEqual(self.config.get_merge('base', 'amd64', None, None,
+                                               'a'), 1)
+        self.config.clear()
+        self.assertEqual(self.config.merge('base', 'amd64'), {})
+
+    def test_pickle(self):
+        self.config.merge('base', 'amd64')
+        config = pickle.loads(pickle.dumps(self.config))
+        self.assertEqual(config._index, {})
+        self.assertEqual(config, self.config)
+        self.assertEqual(config.merge('base', 'amd64', 'none', 'f'),
+                         self.config.merge('base', 'amd64', 'none', 'f'))
+
+
+class _ConfigCoreDumpTest(unittest.TestCase):
+    def setUp(self):
+        self.config = ConfigCore()
+        self.config['base', ] = {'arches': ['amd64', 'i386'], 'enabled': True}
+        self.config['base', 'amd64'] = {'n': -1, 'x': None, 'f': False}
+        self.config['image', 'amd64', 'none', 'f'] = {
+            'l': [1, 'a', ['b']], 't': ('c', 2), 'd': {'k': 'v'}}
+        self.config['build', None, 'rt'] = {'s': 'caf\xe9'}
+
+    def dump(self, config):
+        f = io.BytesIO()
+        config.dump(f)
+        return f.getvalue()
+
+    def test_round_trip(self):
+        data = self.dump(self.config)
+        config = ConfigCoreDump(io.BytesIO(data))
+        self.assertEqual(list(config), list(self.config))
+        self.assertEqual(config, self.config)
+        self.assertEqual(config.merge('base', 'amd64'),
+                         self.config.merge('base', 'amd64'))
+        self.assertEqual(self.dump(config), data)
+
+    def test_pickle(self):
+        # Dumps written before the binary format are still read
+        data = pickle.dumps(self.config)
+        self.assertEqual(ConfigCoreDump(io.BytesIO(data)), self.config)
+
+    def test_invalid(self):
+        self.config['bad', ] = {'v': 1.5}
+        self.assertRaises(TypeError, self.dump, self.config)
+
+
+class _ConfigCoreHierarchyTest(unittest.TestCase):
+    schema = {'image': {'configs': SchemaItemList()}}
+
+    files = {
+        'defines': '[base]\narches: amd64 i386\nfeaturesets: none rt\n'
+                   '[image]\nconfigs: c\n',
+        'amd64/defines': '[base]\nflavours: a b\nfeaturesets: rt\n'
+                         '[a_image]\nconfigs: a\n',
+        'amd64/rt/defines': '[base]\nflavours: a\n',
+        'i386/defines': '[base]\nflavours: c\nfeaturesets: rt\n',
+        'featureset-rt/defines': '[image]\nconfigs: rt\n',
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, data in self.files.items():
+            self.write(name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        name = os.path.join(self.dir, 'config', name)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'w') as f:
+            f.write(data)
+
+    def read(self, **kwargs):
+        return ConfigCoreHierarchy(self.schema,
+                                   [os.path.join(self.dir, 'config')],
+                                   **kwargs)
+
+    def test_read(self):
+        config = self.read()
+        self.assertEqual(config['base', 'amd64']['featuresets'],
+                         ['none', 'rt'])
+        self.assertEqual(config['base', 'amd64', 'none']['flavours'],
+                         ['a', 'b'])
+        self.assertEqual(config.get_merge('image', 'amd64', 'none', 'a',
+                                          'configs'), ['a', 'c'])
+        self.assertEqual(config['image', None, 'rt'], {'configs': ['rt']})
+
+    def test_jobs(self):
+        config = self.read()
+        parallel = self.read(jobs=3)
+        self.assertEqual(list(parallel), list(config))
+        self.assertEqual(parallel, config)
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        config = self.read()
+        self.assertEqual(self.read(cache_dir=cache_dir), config)
+        cached = self.read(cache_dir=cache_dir)
+        self.assertIsInstance(cached, _ConfigCoreLazy)
+        self.assertEqual(cached, config)
+        # A change of any file read, or a new one, is noticed
+        self.write('i386/defines', '[base]\nflavours: d\nfeaturesets: rt\n')
+        config = self.read()
+        self.assertEqual(self.read(cache_dir=cache_dir), config)
+        self.write('i386/rt/defines', '[base]\nflavours: d\n')
+        config = self.read()
+        self.assertEqual(self.read(cache_dir=cache_dir), config)
+        self.assertNotIsInstance(config, _ConfigCoreLazy)
+
+    def test_cache_error(self):
+        cache = _HierarchyCache(os.path.join(self.dir, 'cache'))
+        config = self.read()
+        config['bad', ] = {'v': 1.5}
+        self.assertRaises(TypeError, cache.put, 'key', config, [])
+        self.assertEqual(os.listdir(cache.dir), [])
+
+
+class _ConfigParserTest(unittest.TestCase):
+    schema = {'base': {'flavours': SchemaItemList(),
+                       'enabled': SchemaItemBoolean()}}
+
+    def setUp(self):
+        fd, self.name = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('[base]\nflavours: a b\nenabled: true\n'
+                    '[amd64_base]\nflavours: c\n[other]\nx: 1\n')
+
+    def tearDown(self):
+        os.unlink(self.name)
+
+    def test_convert(self):
+        config = ConfigParser(self.schema)
+        config.read(self.name)
+        self.assertEqual(list(config),
+                         [('base', ), ('amd64', 'base'), ('other', )])
+        self.assertEqual(dict(config['base', ]),
+                         {'flavours': ['a', 'b'], 'enabled': True})
+        self.assertEqual(dict(config['amd64', 'base']), {'flavours': ['c']})
+        self.assertEqual(dict(config['other', ]), {'x': '1'})
+
+    def test_memo(self):
+        config = ConfigParser(self.schema)
+        config.read(self.name)
+        section = config['base', ]
+        self.assertIs(config['base', ], section)
+        with self.assertRaises(TypeError):
+            section['enabled'] = False
+        # Reading more files converts again
+        with open(self.name, 'w') as f:
+            f.write('[base]\nenabled: false\n')
+        config.read(self.name)
+        self.assertEqual(config['base', ]['enabled'], False)
+        self.assertEqual(section['enabled'], True)
+
+
 if __name__ == '__main__':
     sys.path.append('debian/lib/python')
     config = ConfigCoreDump(open('debian/config.defines.dump', 'rb'))
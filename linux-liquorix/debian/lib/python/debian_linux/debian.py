@@ -1,5 +1,6 @@
 import collections
 import collections.abc
+import copy
 import os.path
 import re
 import unittest
@@ -7,7 +8,12 @@ import unittest
 from . import utils
 
 
-class Changelog(list):
+# Entries are parsed on access.  Every line that doesn't start with white
+# space starts an entry, so an index of their offsets, found with one
+# regex scan as far as needed, gives random access; limit bounds the
+# number of entries looked at.  Errors in the file are only reported
+# when the entry they are in is accessed.
+class Changelog(collections.abc.Sequence):
     _top_rules = r"""
 ^
 (?P<source>
@@ -45,29 +51,106 @@ class Changelog(list):
     _bottom_re = re.compile(_bottom_rules, re.X)
     _ignore_re = re.compile(r'^(?:  |\s*\n)')
 
+    _start_re = re.compile(r'^\S', re.M)
+    _line_re = re.compile(r'.*\n|.+')
+
     class Entry(object):
-        __slot__ = ('distribution', 'source', 'version', 'urgency',
-                    'maintainer', 'date')
+        __slots__ = ('distribution', 'source', 'version', 'urgency',
+                     'maintainer', 'date')
 
         def __init__(self, **kwargs):
             for key, value in kwargs.items():
                 setattr(self, key, value)
 
-    def __init__(self, dir='', version=None, file=None):
+    def __init__(self, dir='', version=None, file=None, limit=None):
         if version is None:
             version = Version
+        self._version, self._limit = version, limit
         if file:
-            self._parse(version, file)
+            self._text = file.read() if hasattr(file, 'read') \
+                else ''.join(file)
         else:
             with open(os.path.join(dir, "debian/changelog"),
                       encoding="UTF-8") as f:
-                self._parse(version, f)
+                self._text = f.read()
+        # Offsets of the entry starts, and the number of lines before each
+        self._starts, self._start_lines = [], []
+        self._starts_iter = self._start_re.finditer(self._text)
+        self._entries = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or (self._limit is not None and index >= self._limit):
+            raise IndexError('changelog index out of range')
+        entry = self._entries.get(index)
+        if entry is None:
+            entry = self._parse(index)
+            if entry is None:
+                raise IndexError('changelog index out of range')
+            self._entries[index] = entry
+        return entry
 
-    def _parse(self, version, f):
+    def __len__(self):
+        limit = self._limit
+        self._find_starts(-1 if limit is None else limit + 1)
+        ret = len(self._starts)
+        if limit is not None and ret > limit:
+            return limit
+        # The last entry may lack its bottom line
+        if ret and ret - 1 not in self._entries and \
+                self._parse(ret - 1) is None:
+            ret -= 1
+        if not ret:
+            self._parse(0)
+        return ret
+
+    def _find_starts(self, count):
+        # Scan for the first count starts, all of them if count is -1
+        while len(self._starts) != count and self._starts_iter is not None:
+            match = next(self._starts_iter, None)
+            if match is None:
+                self._starts_iter = None
+            else:
+                start = match.start()
+                if self._starts:
+                    line_no = self._start_lines[-1] + \
+                        self._text.count('\n', self._starts[-1], start)
+                else:
+                    line_no = self._text.count('\n', 0, start)
+                self._starts.append(start)
+                self._start_lines.append(line_no)
+
+    def _lines(self, start, end):
+        return self._line_re.findall(self._text, start, end)
+
+    # Parse the entry starting at the index-th start, the same way as if
+    # the file were parsed line by line from the beginning.  Returns None
+    # if there is no such entry.
+    def _parse(self, index):
+        self._find_starts(index + 2)
+        starts, text = self._starts, self._text
+        if index == 0:
+            # Only empty and indented lines may come before the first entry
+            end = starts[0] if starts else len(text)
+            line_no = 0
+            for line in self._lines(0, end):
+                line_no += 1
+                if not self._ignore_re.match(line):
+                    raise Exception('invalid top line %d in changelog' %
+                                    line_no)
+        if index >= len(starts):
+            return None
+        start = starts[index]
+        end = starts[index + 1] if index + 1 < len(starts) else len(text)
+
+        ret = None
         top_match = None
-        line_no = 0
+        line_no = self._start_lines[index]
 
-        for line in f:
+        for line in self._lines(start, end):
             line_no += 1
 
             if self._ignore_re.match(line):
@@ -78,9 +161,9 @@ class Changelog(list):
                     raise Exception('invalid top line %d in changelog' %
                                     line_no)
                 try:
-                    v = version(top_match.group('version'))
+                    v = self._version(top_match.group('version'))
                 except Exception:
-                    if not len(self):
+                    if not index:
                         raise
                     v = Version(top_match.group('version'))
             else:
@@ -89,22 +172,92 @@ class Changelog(list):
                     raise Exception('invalid bottom line %d in changelog' %
                                     line_no)
 
-                self.append(self.Entry(
+                ret = self.Entry(
                     distribution=top_match.group('distribution'),
                     source=top_match.group('source'),
                     version=v,
                     urgency=top_match.group('urgency'),
                     maintainer=bottom_match.group('maintainer'),
-                    date=bottom_match.group('date')))
+                    date=bottom_match.group('date'))
                 top_match = bottom_match = None
 
+        if top_match is not None and end < len(text):
+            # The next entry's top line is taken for the bottom line
+            raise Exception('invalid bottom line %d in changelog' %
+                            (line_no + 1))
+        return ret
+
+
+class _ChangelogTest(unittest.TestCase):
+    text = (
+        'linux (2.0-1) unstable; urgency=medium\n\n'
+        '  * Two\n\n'
+        ' -- A B <a@example.org>  Mon, 02 Jan 2023 00:00:00 +0000\n\n'
+        'linux (1.0-1) unstable; urgency=low\n\n'
+        '  * One\n\n'
+        ' -- A B <a@example.org>  Sun, 01 Jan 2023 00:00:00 +0000\n'
+    )
 
+    def test_entries(self):
+        c = Changelog(file=[self.text])
+        self.assertEqual(len(c), 2)
+        self.assertEqual([str(i.version) for i in c], ['2.0-1', '1.0-1'])
+        self.assertEqual(c[-1].urgency, 'low')
+
+    def test_limit(self):
+        c = Changelog(file=[self.text], limit=1)
+        self.assertEqual(len(c), 1)
+        self.assertRaises(IndexError, c.__getitem__, 1)
+
+    def test_lazy_errors(self):
+        c = Changelog(file=[self.text + 'garbage\n'])
+        self.assertEqual(c[1].version.upstream, '1.0')
+        with self.assertRaisesRegex(Exception, 'invalid top line 12'):
+            len(c)
+
+
+# Versions order like dpkg's: by epoch, then upstream version, then
+# revision, a missing epoch or revision being 0.  Versions are compared
+# through a sort key computed once per object.
+#
+# Versions are immutable, so constructing one for a string that was seen
+# recently returns the same object again instead of parsing it anew.
 class Version(object):
+    __slots__ = 'epoch', 'upstream', 'revision', '_sort_key'
+
     _epoch_re = re.compile(r'\d+$')
     _upstream_re = re.compile(r'[0-9][A-Za-z0-9.+\-:~]*$')
     _revision_re = re.compile(r'[A-Za-z0-9+.~]+$')
 
-    def __init__(self, version):
+    # Instances by class and string, shared by all version classes and
+    # emptied when full
+    _cache = {}
+    _cache_size = 1 << 14
+
+    def __new__(cls, version):
+        cache = cls._cache
+        ret = cache.get((cls, version))
+        if ret is None:
+            ret = super(Version, cls).__new__(cls)
+            ret._parse(version)
+            object.__setattr__(ret, '_sort_key', None)
+            if len(cache) >= cls._cache_size:
+                cache.clear()
+            cache[cls, version] = ret
+        return ret
+
+    def __reduce__(self):
+        return self.__class__, (self.complete, )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are immutable" %
+                             self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s objects are immutable" %
+                             self.__class__.__name__)
+
+    def _parse(self, version):
         try:
             split = version.index(':')
         except ValueError:
@@ -121,13 +274,80 @@ class Version(object):
            not self._upstream_re.match(upstream) or \
            (revision is not None and not self._revision_re.match(revision)):
             raise RuntimeError(u"Invalid debian version")
-        self.epoch = epoch and int(epoch)
-        self.upstream = upstream
-        self.revision = revision
+        set = object.__setattr__
+        set(self, 'epoch', epoch and int(epoch))
+        set(self, 'upstream', upstream)
+        set(self, 'revision', revision)
 
     def __str__(self):
         return self.complete
 
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key == other.sort_key
+
+    def __ne__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key != other.sort_key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key < other.sort_key
+
+    def __le__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key <= other.sort_key
+
+    def __gt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key > other.sort_key
+
+    def __ge__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.sort_key >= other.sort_key
+
+    def __hash__(self):
+        return hash(self.sort_key)
+
+    # dpkg compares a version part as alternating runs of non-digits,
+    # character by character, and digits, numerically, the shorter part
+    # going on with empty runs.  In the non-digit runs, ~ sorts before
+    # the end of the run, which sorts before letters, which sort before
+    # everything else.  Every non-digit run is translated to a string
+    # that compares that way as a whole, ending with \x01 for the end of
+    # the run; the digits become an int.  A part always gets at least one
+    # pair of runs, and an empty one at the end stands for all the runs
+    # the other part might have left, so plain tuple comparison works.
+    _part_re = re.compile(r'([^0-9]*)([0-9]*)')
+    _part_table = dict((i, i + 256) for i in range(128))
+    _part_table.update((ord(i), ord(i)) for i in
+                       'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+    _part_table[ord('~')] = 0
+
+    @classmethod
+    def _part_key(cls, part):
+        table = cls._part_table
+        ret = [(nondigits.translate(table) + '\x01', int(digits or 0))
+               for nondigits, digits in cls._part_re.findall(part)]
+        if not part:
+            ret.append(('\x01', 0))
+        return tuple(ret)
+
+    @property
+    def sort_key(self):
+        if self._sort_key is None:
+            object.__setattr__(self, '_sort_key', (
+                self.epoch or 0,
+                self._part_key(self.upstream),
+                self._part_key(self.revision or '')))
+        return self._sort_key
+
     @property
     def complete(self):
         if self.epoch is not None:
@@ -148,6 +368,22 @@ class Version(object):
         return self.revision
 
 
+# Sort versions, given as strings or Version objects, like dpkg does.
+# Every distinct string is parsed once, with the version class given.
+def sort_versions(versions, version=Version, reverse=False):
+    keys = {}
+
+    def key(i):
+        if isinstance(i, Version):
+            return i.sort_key
+        ret = keys.get(i)
+        if ret is None:
+            ret = keys[i] = version(i).sort_key
+        return ret
+
+    return sorted(versions, key=key, reverse=reverse)
+
+
 class _VersionTest(unittest.TestCase):
     def test_native(self):
         v = Version('1.2+c~4')
@@ -220,8 +456,37 @@ class _VersionTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             Version('1-2:3')
 
+    def test_order(self):
+        ordered = ['1.0~rc1', '1.0', '1.0-1~bpo1', '1.0-1', '1.0-1+b1',
+                   '1.0a', '1.0+', '1.0.1', '1.1', '1.10', '1:0.1']
+        for a, b in zip(ordered, ordered[1:]):
+            self.assertLess(Version(a), Version(b))
+            self.assertGreater(Version(b), Version(a))
+        self.assertEqual(sort_versions(reversed(ordered)), ordered)
+        self.assertEqual(sort_versions(ordered, reverse=True),
+                         ordered[::-1])
+
+    def test_equal(self):
+        for a, b in (('1.0', '0:1.0'), ('1.0', '1.0-0'), ('1.01', '1.1')):
+            self.assertEqual(Version(a), Version(b))
+            self.assertEqual(hash(Version(a)), hash(Version(b)))
+        self.assertNotEqual(Version('1.0'), Version('1.0.0'))
+
+    def test_shared(self):
+        v = Version('1.0-1')
+        self.assertIs(Version('1.0-1'), v)
+        self.assertIsNot(VersionLinux('1.0-1'), v)
+        self.assertIs(copy.deepcopy(v), v)
+        with self.assertRaises(AttributeError):
+            v.revision = '2'
+
 
 class VersionLinux(Version):
+    __slots__ = ('linux_modifier', 'linux_version', 'linux_upstream',
+                 'linux_upstream_full', 'linux_dfsg',
+                 'linux_revision_experimental', 'linux_revision_security',
+                 'linux_revision_backports', 'linux_revision_other')
+
     _upstream_re = re.compile(r"""
 (?P<version>
     \d+\.\d+
@@ -267,27 +532,36 @@ $
 $
     """, re.X)
 
-    def __init__(self, version):
-        super(VersionLinux, self).__init__(version)
+    # The generic parts come from the cached Version for the same string,
+    # so falling back to Version if this one fails doesn't parse it again
+    def _parse(self, version):
+        base = Version(version)
+        set = object.__setattr__
+        set(self, 'epoch', base.epoch)
+        set(self, 'upstream', base.upstream)
+        set(self, 'revision', base.revision)
         up_match = self._upstream_re.match(self.upstream)
         rev_match = self._revision_re.match(self.revision)
         if up_match is None or rev_match is None:
             raise RuntimeError(u"Invalid debian linux version")
         d = up_match.groupdict()
-        self.linux_modifier = d['modifier']
-        self.linux_version = d['version']
         if d['modifier'] is not None:
             assert not d['update']
-            self.linux_upstream = '-'.join((d['version'], d['modifier']))
+            linux_upstream = '-'.join((d['version'], d['modifier']))
         else:
-            self.linux_upstream = d['version']
-        self.linux_upstream_full = self.linux_upstream + d['update']
-        self.linux_dfsg = d['dfsg']
+            linux_upstream = d['version']
+        set(self, 'linux_modifier', d['modifier'])
+        set(self, 'linux_version', d['version'])
+        set(self, 'linux_upstream', linux_upstream)
+        set(self, 'linux_upstream_full', linux_upstream + d['update'])
+        set(self, 'linux_dfsg', d['dfsg'])
         d = rev_match.groupdict()
-        self.linux_revision_experimental = d['revision_experimental'] and True
-        self.linux_revision_security = d['revision_security'] and True
-        self.linux_revision_backports = d['revision_backports'] and True
-        self.linux_revision_other = d['revision_other'] and True
+        set(self, 'linux_revision_experimental',
+            d['revision_experimental'] and True)
+        set(self, 'linux_revision_security', d['revision_security'] and True)
+        set(self, 'linux_revision_backports',
+            d['revision_backports'] and True)
+        set(self, 'linux_revision_other', d['revision_other'] and True)
 
 
 class _VersionLinuxTest(unittest.TestCase):
@@ -401,11 +675,14 @@ class _VersionLinuxTest(unittest.TestCase):
         self.assertTrue(v.linux_revision_other)
 
 
+# Values of control file fields keep their rendered form until they are
+# changed
 class PackageArchitecture(collections.abc.MutableSet):
-    __slots__ = '_data'
+    __slots__ = '_data', '_str'
 
     def __init__(self, value=None):
         self._data = set()
+        self._str = None
         if value:
             self.extend(value)
 
@@ -419,13 +696,19 @@ class PackageArchitecture(collections.abc.MutableSet):
         return self._data.__len__()
 
     def __str__(self):
-        return ' '.join(sorted(self))
+        if self._str is None:
+            self._str = ' '.join(sorted(self))
+        return self._str
 
     def add(self, value):
-        self._data.add(value)
+        if value not in self._data:
+            self._data.add(value)
+            self._str = None
 
     def discard(self, value):
-        self._data.discard(value)
+        if value in self._data:
+            self._data.discard(value)
+            self._str = None
 
     def extend(self, value):
         if isinstance(value, str):
@@ -435,12 +718,20 @@ class PackageArchitecture(collections.abc.MutableSet):
             raise RuntimeError
 
 
+# As short and long are changed in place, the rendered form is kept with
+# a snapshot of both.  Paragraphs are wrapped by one shared wrapper, and
+# every distinct paragraph only once.
 class PackageDescription(object):
-    __slots__ = "short", "long"
+    __slots__ = "short", "long", "_str"
+
+    _wrap = utils.TextWrapper(width=74, fix_sentence_endings=True).wrap
+    _wrapped = {}
+    _wrapped_size = 1 << 12
 
     def __init__(self, value=None):
         self.short = []
         self.long = []
+        self._str = None
         if value is not None:
             desc_split = value.split("\n", 1)
             self.append_short(desc_split[0])
@@ -448,12 +739,23 @@ class PackageDescription(object):
                 self.append(desc_split[1])
 
     def __str__(self):
-        wrap = utils.TextWrapper(width=74, fix_sentence_endings=True).wrap
+        snapshot = tuple(self.short), tuple(self.long)
+        if self._str is None or self._str[0] != snapshot:
+            self._str = snapshot, self._render()
+        return self._str[1]
+
+    def _render(self):
+        wrapped = self._wrapped
         short = ', '.join(self.short)
         long_pars = []
         for i in self.long:
-            long_pars.append(wrap(i))
-        long = '\n .\n '.join(['\n '.join(i) for i in long_pars])
+            par = wrapped.get(i)
+            if par is None:
+                if len(wrapped) >= self._wrapped_size:
+                    wrapped.clear()
+                par = wrapped[i] = '\n '.join(self._wrap(i))
+            long_pars.append(par)
+        long = '\n .\n '.join(long_pars)
         return short + '\n ' + long if long else short
 
     def append(self, str):
@@ -475,29 +777,85 @@ class PackageDescription(object):
 
 
 class PackageRelation(list):
+    # A group is merged into the first one that matches it: each entry
+    # must equal the other group's entry at the same position, except for
+    # the arches, up to the length of the shorter group.  To find it
+    # without comparing every group, the keys of every prefix of a group
+    # map to the position of the first group starting with it, and the
+    # keys of whole groups to the first group equal to it.  Entries must
+    # not be changed, except for their arches, while in a relation; the
+    # index is rebuilt for copies and after list operations other than
+    # append and extend.
     def __init__(self, value=None, override_arches=None):
+        self._index = None
         if value:
             self.extend(value, override_arches)
 
+    # Copies are filled through append(), like any list subclass.  As the
+    # entries of a deep copy are usually changed right away, its index is
+    # only built when it is next used.
+    def __copy__(self):
+        ret = self.__class__()
+        for i in self:
+            ret.append(i)
+        return ret
+
+    def __deepcopy__(self, memo):
+        ret = memo[id(self)] = self.__class__()
+        for i in self:
+            ret.append(copy.deepcopy(i, memo))
+        ret._invalidate()
+        return ret
+
     def __str__(self):
         return ', '.join(str(i) for i in self)
 
+    def _build_index(self):
+        # Position of the first group that starts with a key, of the first
+        # group equal to one, and of the first group that isn't empty
+        self._index = {}, {}, [None]
+        for pos, group in enumerate(self):
+            self._add_index(pos, group)
+
+    def _add_index(self, pos, group):
+        prefixes, groups, first = self._index
+        keys = group._keys()
+        for key in keys:
+            prefixes.setdefault(key, pos)
+        if keys:
+            groups.setdefault(keys[-1], pos)
+            if first[0] is None:
+                first[0] = pos
+
     def _search_value(self, value):
-        for i in self:
-            if i._search_value(value):
-                return i
+        if getattr(self, '_index', None) is None:
+            self._build_index()
+        prefixes, groups, first = self._index
+        keys = value._keys()
+        if not keys:
+            # Empty groups match any group, but are never matched
+            return first[0]
+        found = [prefixes.get(keys[-1])]
+        found.extend(groups.get(key) for key in keys[:-1])
+        found = [i for i in found if i is not None]
+        if found:
+            return min(found)
         return None
 
+    def _invalidate(self):
+        self._index = None
+
     def append(self, value, override_arches=None):
         if isinstance(value, str):
             value = PackageRelationGroup(value, override_arches)
         elif not isinstance(value, PackageRelationGroup):
             raise ValueError(u"got %s" % type(value))
-        j = self._search_value(value)
-        if j:
-            j._update_arches(value)
+        pos = self._search_value(value)
+        if pos is not None:
+            self[pos]._update_arches(value)
         else:
             super(PackageRelation, self).append(value)
+            self._add_index(len(self) - 1, value)
 
     def extend(self, value, override_arches=None):
         if isinstance(value, str):
@@ -505,6 +863,42 @@ class PackageRelation(list):
         for i in value:
             self.append(i, override_arches)
 
+    def __delitem__(self, key):
+        self._invalidate()
+        super(PackageRelation, self).__delitem__(key)
+
+    def __iadd__(self, value):
+        self._invalidate()
+        return super(PackageRelation, self).__iadd__(value)
+
+    def __setitem__(self, key, value):
+        self._invalidate()
+        super(PackageRelation, self).__setitem__(key, value)
+
+    def clear(self):
+        self._invalidate()
+        super(PackageRelation, self).clear()
+
+    def insert(self, index, value):
+        self._invalidate()
+        super(PackageRelation, self).insert(index, value)
+
+    def pop(self, *args):
+        self._invalidate()
+        return super(PackageRelation, self).pop(*args)
+
+    def remove(self, value):
+        self._invalidate()
+        super(PackageRelation, self).remove(value)
+
+    def reverse(self):
+        self._invalidate()
+        super(PackageRelation, self).reverse()
+
+    def sort(self, *args, **kwargs):
+        self._invalidate()
+        super(PackageRelation, self).sort(*args, **kwargs)
+
 
 class PackageRelationGroup(list):
     def __init__(self, value=None, override_arches=None):
@@ -514,12 +908,13 @@ class PackageRelationGroup(list):
     def __str__(self):
         return ' | '.join(str(i) for i in self)
 
-    def _search_value(self, value):
-        for i, j in zip(self, value):
-            if i.name != j.name or i.operator != j.operator or \
-               i.version != j.version or i.restrictions != j.restrictions:
-                return None
-        return self
+    # The keys of every prefix of the group
+    def _keys(self):
+        ret, key = [], ()
+        for i in self:
+            key += (i._key(), )
+            ret.append(key)
+        return ret
 
     def _update_arches(self, value):
         for i, j in zip(self, value):
@@ -600,6 +995,11 @@ class PackageRelationEntry(object):
         if override_arches:
             self.arches = list(override_arches)
 
+    # What identifies the entry in a relation, everything but the arches
+    def _key(self):
+        return (self.name, self.operator and self.operator._op, self.version,
+                tuple(self.restrictions))
+
     def __str__(self):
         ret = [self.name]
         if self.operator is not None and self.version is not None:
@@ -631,7 +1031,40 @@ class PackageRelationEntry(object):
             self.restrictions = []
 
 
+class _PackageRelationTest(unittest.TestCase):
+    def test_merge(self):
+        r = PackageRelation('a [amd64], b (>= 1), c')
+        r.extend('b (>= 1), a [i386], b (>= 2)')
+        self.assertEqual(str(r), 'a [amd64 i386], b (>= 1), c, b (>= 2)')
+
+    def test_merge_prefix(self):
+        r = PackageRelation('a | b, c')
+        r.extend('a, c | d, e')
+        self.assertEqual(str(r), 'a | b, c, e')
+
+    def test_merge_restrictions(self):
+        r = PackageRelation('a <!nocheck>')
+        r.extend('a, a <!nocheck>')
+        self.assertEqual(str(r), 'a <!nocheck>, a')
+
+    def test_deepcopy(self):
+        r = copy.deepcopy(PackageRelation('a-@x@, b'))
+        r[0][0].name = 'a-1'
+        r.append('a-1')
+        self.assertEqual(str(r), 'a-1, b')
+
+
+# Fields are written in the order of _fields, then any others sorted by
+# name.  The sort key is set up once per class.
 class _ControlFileDict(dict):
+    def __init_subclass__(cls, **kwargs):
+        super(_ControlFileDict, cls).__init_subclass__(**kwargs)
+        order = dict((name, pos) for pos, name in enumerate(cls._fields))
+
+        def field_key(name, order=order, rest=len(order)):
+            return order.get(name, rest), name
+        cls._field_key = staticmethod(field_key)
+
     def __setitem__(self, key, value):
         try:
             cls = self._fields[key]
@@ -642,13 +1075,8 @@ class _ControlFileDict(dict):
         super(_ControlFileDict, self).__setitem__(key, value)
 
     def keys(self):
-        keys = set(super(_ControlFileDict, self).keys())
-        for i in self._fields.keys():
-            if i in self:
-                keys.remove(i)
-                yield i
-        for i in sorted(list(keys)):
-            yield i
+        return iter(sorted(super(_ControlFileDict, self).keys(),
+                           key=self._field_key))
 
     def items(self):
         for i in self.keys():
@@ -696,5 +1124,21 @@ class TestsControl(_ControlFileDict):
     ))
 
 
+class _ControlFileTest(unittest.TestCase):
+    def test_keys(self):
+        p = Package()
+        for key in ('X-Foo', 'Description', 'Package', 'Depends', 'A'):
+            p[key] = 'a'
+        self.assertEqual(list(p.keys()),
+                         ['Package', 'Depends', 'Description', 'A', 'X-Foo'])
+
+    def test_description(self):
+        d = PackageDescription('short\nfirst paragraph')
+        self.assertEqual(str(d), 'short\n first paragraph')
+        d.long.append('second')
+        d.short = ['other']
+        self.assertEqual(str(d), 'other\n first paragraph\n .\n second')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,17 @@
-import codecs
+import concurrent.futures
+import io
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
+import unittest
 from collections import OrderedDict
 
+from .config import ConfigCore
 from .debian import Changelog, PackageArchitecture, PackageDescription, \
     PackageRelation, Version
+from .utils import Template, Templates, Timings, update_file, write_rfc822
 
 
 class PackagesList(OrderedDict):
@@ -15,11 +22,35 @@ class PackagesList(OrderedDict):
         for package in packages:
             self[package['Package']] = package
 
+    def merge(self, new, arch):
+        for new_package in new:
+            name = new_package['Package']
+            if name in self:
+                package = self.get(name)
+                package['Architecture'].add(arch)
+
+                for field in ('Depends', 'Provides', 'Suggests', 'Recommends',
+                              'Conflicts'):
+                    if field in new_package:
+                        if field in package:
+                            v = package[field]
+                            v.extend(new_package[field])
+                        else:
+                            package[field] = new_package[field]
 
+            else:
+                new_package['Architecture'] = arch
+                self.append(new_package)
+
+
+# Unless parallel is set, the makefile is run serially.  A parallel
+# makefile must order every target after everything it relies on.
 class Makefile(object):
-    def __init__(self):
+    def __init__(self, parallel=False):
         self.rules = {}
-        self.add('.NOTPARALLEL')
+        self.parallel = parallel
+        if not parallel:
+            self.add('.NOTPARALLEL')
 
     def add(self, name, deps=None, cmds=None):
         if name in self.rules:
@@ -93,25 +124,165 @@ def iter_flavours(config, arch, featureset):
     return iter(config['base', arch, featureset]['flavours'])
 
 
+# A relation with templates for the names and versions of its entries.
+# Relations are compiled once per class and text, and substituting builds
+# the groups and entries of the result directly, without parsing them or
+# copying the relation.
+class _RelationTemplate(object):
+    __slots__ = '_cls', '_groups'
+
+    _cache = {}
+    _cache_size = 1 << 10
+
+    def __new__(cls, dep):
+        cache = cls._cache
+        key = dep.__class__, str(dep)
+        ret = cache.get(key)
+        if ret is None:
+            ret = super(_RelationTemplate, cls).__new__(cls)
+            ret._cls = dep.__class__
+            ret._groups = [
+                (group.__class__,
+                 [(item.__class__, Template(item.name), item.operator,
+                   item.version and Template(item.version),
+                   tuple(item.arches), tuple(item.restrictions))
+                  for item in group])
+                for group in dep]
+            if len(cache) >= cls._cache_size:
+                cache.clear()
+            cache[key] = ret
+        return ret
+
+    def substitute(self, vars):
+        ret = self._cls()
+        for group_cls, items in self._groups:
+            group = group_cls()
+            for cls, name, operator, version, arches, restrictions in items:
+                item = cls.__new__(cls)
+                item.name = name.substitute(vars)
+                item.operator = operator
+                item.version = version and version.substitute(vars)
+                item.arches = list(arches)
+                item.restrictions = list(restrictions)
+                list.append(group, item)
+            list.append(ret, group)
+        return ret
+
+
+# Stands in for the packages list or makefile in a worker process.  Calls
+# of methods on it or on its items are logged, to be made on the real
+# object in the parent, and return None.  The real object is not there to
+# read from, so anything that would read it raises instead of giving a
+# result that differs from a serial run.
+class _CallLog(object):
+    def __init__(self, log, path, **attrs):
+        self.__dict__.update(attrs)
+        self._log, self._path = log, path
+
+    def __bool__(self):
+        self._read()
+
+    def __contains__(self, key):
+        self._read()
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self._log.append((self._path, name, args, kwargs))
+        return call
+
+    def __getitem__(self, key):
+        return _CallLog(self._log, self._path + (key, ))
+
+    def __iter__(self):
+        self._read()
+
+    def __len__(self):
+        self._read()
+
+    def _read(self):
+        raise RuntimeError("Can't read %s while expanding flavours in a "
+                           "pool, use jobs=1" % '.'.join(map(str, self._path)))
+
+
+# The Gencontrol worker processes expand flavours with, inherited on fork
+_flavour_gencontrol = None
+
+
+def _init_flavour_worker(gencontrol):
+    global _flavour_gencontrol
+    _flavour_gencontrol = gencontrol
+
+
+def _do_flavour(parallel, args):
+    self = _flavour_gencontrol
+    for name in self.flavour_state:
+        setattr(self, name, type(getattr(self, name))())
+    if self.timings is not None:
+        self.timings.clear()
+    log = []
+    self.do_flavour(_CallLog(log, ('packages', )),
+                    _CallLog(log, ('makefile', ), parallel=parallel), *args)
+    return log, [(name, getattr(self, name)) for name in self.flavour_state], \
+        self.timings
+
+
 class Gencontrol(object):
     makefile_targets = ('binary-arch', 'build-arch', 'setup')
     makefile_targets_indep = ('binary-indep', 'build-indep', 'setup')
 
-    def __init__(self, config, templates, version=Version):
+    # With jobs above 1, the flavours of a featureset are expanded in that
+    # many processes.  do_flavour() may then only call methods of the
+    # packages list and makefile, or their items, and only change the
+    # attributes listed here, which must be dicts of new entries.  The
+    # results are merged in flavour order, the same as a serial run.
+    flavour_state = ('files', )
+
+    # Given timings, a utils.Timings, the hooks, process_package(),
+    # merge_build_depends() and the writers record their calls and wall
+    # time there, including those run in worker processes
+    def __init__(self, config, templates, version=Version, parallel=False,
+                 jobs=1, timings=None):
         self.config, self.templates = config, templates
         self.changelog = Changelog(version=version)
         self.vars = {}
+        self.parallel = parallel
+        self.jobs, self.flavour_pool = jobs, None
+        # Files are rendered into memory first, write_files() then only
+        # writes those whose content changed
+        self.files = OrderedDict()
+        self.files_written, self.files_unchanged = [], []
+        self.timings = timings
+        if timings is not None:
+            timings.instrument(self, [
+                name for name in dir(type(self))
+                if name.startswith(('do_', 'write')) or
+                name in ('process_package', 'merge_build_depends')])
 
     def __call__(self):
-        packages = PackagesList()
-        makefile = Makefile()
+        self.generate()
+        self.write_files()
 
-        self.do_source(packages)
-        self.do_main(packages, makefile)
-        self.do_extra(packages, makefile)
+    # Generate everything without touching the disk.  Returns the packages
+    # list, the makefile and a copy of the rendered files, by name, as
+    # (data, mode) for write_files().
+    def generate(self):
+        packages = PackagesList()
+        makefile = Makefile(self.parallel)
+        self.files.clear()
+        self.files_written, self.files_unchanged = [], []
+
+        try:
+            self.do_source(packages)
+            self.do_main(packages, makefile)
+            self.do_extra(packages, makefile)
+        finally:
+            if self.flavour_pool:
+                self.flavour_pool.shutdown()
+                self.flavour_pool = None
 
         self.merge_build_depends(packages)
         self.write(packages, makefile)
+        return packages, makefile, OrderedDict(self.files)
 
     def do_source(self, packages):
         source = self.templates["control.source"][0]
@@ -271,10 +442,39 @@ class Gencontrol(object):
 
     def do_featureset_recurse(self, packages, makefile, arch, featureset, vars,
                               makeflags, extra):
-        for flavour in iter_flavours(self.config, arch, featureset):
+        flavours = list(iter_flavours(self.config, arch, featureset))
+        if self.jobs > 1 and len(flavours) > 1:
+            self.do_flavours_pool(packages, makefile, arch, featureset,
+                                  flavours, vars, makeflags, extra)
+            return
+        for flavour in flavours:
             self.do_flavour(packages, makefile, arch, featureset, flavour,
                             vars.copy(), makeflags.copy(), extra)
 
+    def do_flavours_pool(self, packages, makefile, arch, featureset, flavours,
+                         vars, makeflags, extra):
+        if self.flavour_pool is None:
+            # Workers are forked, so they share the parsed config,
+            # templates and changelog without pickling them
+            self.flavour_pool = concurrent.futures.ProcessPoolExecutor(
+                self.jobs, multiprocessing.get_context('fork'),
+                _init_flavour_worker, (self, ))
+        args = [(arch, featureset, flavour, vars.copy(), makeflags.copy(),
+                 extra)
+                for flavour in flavours]
+        roots = {'packages': packages, 'makefile': makefile}
+        for log, state, timings in self.flavour_pool.map(
+                _do_flavour, [makefile.parallel] * len(args), args):
+            for path, name, call_args, call_kwargs in log:
+                obj = roots[path[0]]
+                for key in path[1:]:
+                    obj = obj[key]
+                getattr(obj, name)(*call_args, **call_kwargs)
+            for name, value in state:
+                getattr(self, name).update(value)
+            if timings is not None:
+                self.timings.merge(timings)
+
     def do_flavour(self, packages, makefile, arch, featureset, flavour, vars,
                    makeflags, extra):
         vars['localversion'] += '-' + flavour
@@ -306,19 +506,21 @@ class Gencontrol(object):
             makefile.add(target1, [target2])
             makefile.add(target2, [target3])
 
+        # A flavour is set up, built and packaged in its own directories,
+        # but in that order
+        if makefile.parallel:
+            triplet = '_'.join((arch, featureset, flavour))
+            makefile.add('build-arch_%s_real' % triplet,
+                         ['setup_%s_real' % triplet])
+            makefile.add('binary-arch_%s_real' % triplet,
+                         ['build-arch_%s_real' % triplet])
+
     def do_flavour_packages(self, packages, makefile, arch, featureset,
                             flavour, vars, makeflags, extra):
         pass
 
     def process_relation(self, dep, vars):
-        import copy
-        dep = copy.deepcopy(dep)
-        for groups in dep:
-            for item in groups:
-                item.name = self.substitute(item.name, vars)
-                if item.version:
-                    item.version = self.substitute(item.version, vars)
-        return dep
+        return _RelationTemplate(dep).substitute(vars)
 
     def process_description(self, in_desc, vars):
         desc = in_desc.__class__()
@@ -345,11 +547,7 @@ class Gencontrol(object):
     def substitute(self, s, vars):
         if isinstance(s, (list, tuple)):
             return [self.substitute(i, vars) for i in s]
-
-        def subst(match):
-            return vars[match.group(1)]
-
-        return re.sub(r'@([-_a-z0-9]+)@', subst, str(s))
+        return Template(str(s)).substitute(vars)
 
     # Substitute kernel version etc. into maintainer scripts,
     # bug presubj message and lintian overrides
@@ -364,10 +562,8 @@ class Gencontrol(object):
                 continue
             else:
                 target = '%s/%s.%s' % (output_dir, package_name, id)
-                with open(target, 'w') as f:
-                    f.write(self.substitute(template, vars))
-                    os.chmod(f.fileno(),
-                             self.templates.get_mode(name) & 0o777)
+                self.files[target] = (self.substitute(template, vars),
+                                      self.templates.get_mode(name) & 0o777)
 
     def merge_build_depends(self, packages):
         # Merge Build-Depends pseudo-fields from binary packages into the
@@ -397,41 +593,179 @@ class Gencontrol(object):
                 source[dep_type] = PackageRelation()
             source[dep_type].extend(dep)
 
+    # Render the files into self.files
     def write(self, packages, makefile):
         self.write_control(packages.values())
         self.write_makefile(makefile)
 
     def write_control(self, list, name='debian/control'):
-        self.write_rfc822(codecs.open(name, 'w', 'utf-8'), list)
+        f = io.StringIO()
+        self.write_rfc822(f, list)
+        self.files[name] = f.getvalue(), None
 
     def write_makefile(self, makefile, name='debian/rules.gen'):
-        f = open(name, 'w')
+        f = io.StringIO()
         makefile.write(f)
-        f.close()
+        self.files[name] = f.getvalue(), None
+
+    def write_files(self):
+        for name, (data, mode) in self.files.items():
+            if update_file(name, data, mode):
+                self.files_written.append(name)
+            else:
+                self.files_unchanged.append(name)
+        self.files.clear()
 
     def write_rfc822(self, f, list):
-        for entry in list:
-            for key, value in entry.items():
-                f.write(u"%s: %s\n" % (key, value))
-            f.write('\n')
+        write_rfc822(f, list)
 
 
 def merge_packages(packages, new, arch):
-    for new_package in new:
-        name = new_package['Package']
-        if name in packages:
-            package = packages.get(name)
-            package['Architecture'].add(arch)
-
-            for field in ('Depends', 'Provides', 'Suggests', 'Recommends',
-                          'Conflicts'):
-                if field in new_package:
-                    if field in package:
-                        v = package[field]
-                        v.extend(new_package[field])
-                    else:
-                        package[field] = new_package[field]
+    packages.merge(new, arch)
 
-        else:
-            new_package['Architecture'] = arch
-            packages.append(new_package)
+
+class _TestGencontrol(Gencontrol):
+    def do_flavour_packages(self, packages, makefile, arch, featureset,
+                            flavour, vars, makeflags, extra):
+        vars['flavour'] = flavour
+        packages['source']['Build-Depends'].extend(
+            PackageRelation('bc [%s]' % arch))
+        merge_packages(
+            packages,
+            self.process_packages(self.templates['control.image'], vars) +
+            self.process_packages(self.templates['control.common'], vars),
+            arch)
+        makefile.add('binary-arch_%s_%s_%s_real' % (arch, featureset, flavour),
+                     cmds=['$(MAKE) -f debian/rules.real binary-arch-flavour '
+                           '%s' % makeflags])
+        self.files['debian/linux-image%s.postinst' % vars['localversion']] = \
+            self.substitute(self.templates['image.postinst'], vars), None
+
+
+class _RelationTemplateTest(unittest.TestCase):
+    vars = {'abiname': '6.0-1', 'flavour': 'amd64'}
+
+    def test_substitute(self):
+        dep = PackageRelation(
+            'linux-image-@abiname@-@flavour@ (= @abiname@) [amd64] | '
+            'linux-image-@flavour@ <!stage1>, gcc')
+        ret = _RelationTemplate(dep).substitute(self.vars)
+        self.assertEqual(
+            str(ret),
+            'linux-image-6.0-1-amd64 (= 6.0-1) [amd64] | '
+            'linux-image-amd64 <!stage1>, gcc')
+        # The template is left alone and results are not shared
+        self.assertIn('@abiname@', str(dep))
+        ret[0][0].arches.append('i386')
+        self.assertEqual(
+            str(_RelationTemplate(dep).substitute(self.vars)),
+            'linux-image-6.0-1-amd64 (= 6.0-1) [amd64] | '
+            'linux-image-amd64 <!stage1>, gcc')
+
+    def test_class(self):
+        class Relation(PackageRelation):
+            pass
+
+        text = 'linux-@flavour@'
+        self.assertIs(
+            type(_RelationTemplate(PackageRelation(text)).substitute(
+                self.vars)),
+            PackageRelation)
+        self.assertIs(
+            type(_RelationTemplate(Relation(text)).substitute(self.vars)),
+            Relation)
+
+
+class _GencontrolTest(unittest.TestCase):
+    files = {
+        'changelog': (
+            'linux (6.0-1) unstable; urgency=medium\n\n'
+            '  * New\n\n'
+            ' -- A B <a@example.org>  Mon, 02 Jan 2023 00:00:00 +0000\n'),
+        'templates/control.source.in': (
+            'Source: linux\nSection: kernel\nBuild-Depends: debhelper\n'),
+        'templates/control.image.in': (
+            'Package: linux-image@localversion@\n'
+            'Depends: linux-common\n'
+            'Description: Linux for @flavour@\n'
+            ' Linux for @arch@.\n'),
+        'templates/control.common.in': (
+            'Package: linux-common\nDescription: Common files\n'),
+        'templates/image.postinst.in': '#!/bin/sh\necho @localversion@\n',
+    }
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        for name, text in self.files.items():
+            name = os.path.join(self.dir, 'debian', name)
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, 'w') as f:
+                f.write(text)
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def gencontrol(self, cls=_TestGencontrol, **kwargs):
+        config = ConfigCore()
+        config['base', ] = {'arches': ['amd64', 'i386'],
+                            'featuresets': ['none', 'rt']}
+        config['base', 'amd64'] = {'featuresets': ['none', 'rt']}
+        config['base', 'amd64', 'none'] = {'flavours': ['a', 'b', 'c']}
+        config['base', 'amd64', 'rt'] = {'flavours': ['rt1', 'rt2']}
+        config['base', 'i386'] = {'featuresets': ['none']}
+        config['base', 'i386', 'none'] = {'flavours': ['a']}
+        return cls(config, Templates(['debian/templates']), **kwargs)
+
+    def test_generate(self):
+        gencontrol = self.gencontrol()
+        packages, makefile, files = gencontrol.generate()
+        self.assertFalse(os.path.exists('debian/control'))
+        self.assertEqual(
+            sorted(packages['linux-common']['Architecture']),
+            ['amd64', 'i386'])
+        self.assertIn('debian/linux-image-rt-rt2.postinst', files)
+        gencontrol.write_files()
+        # The result is not emptied by writing
+        with open('debian/control') as f:
+            self.assertEqual(f.read(), files['debian/control'][0])
+
+    def test_jobs(self):
+        # Flavours expanded in a pool give the same files, in the same order
+        for parallel in False, True:
+            serial = self.gencontrol(parallel=parallel).generate()[2]
+            pool = self.gencontrol(parallel=parallel, jobs=3).generate()[2]
+            self.assertEqual(list(pool.items()), list(serial.items()))
+
+    def test_read_packages(self):
+        class Gencontrol(_TestGencontrol):
+            def do_flavour_packages(self, packages, *args):
+                if 'linux-common' not in packages:
+                    super(Gencontrol, self).do_flavour_packages(packages,
+                                                                *args)
+
+        # Reading packages in a worker fails rather than differing
+        packages = self.gencontrol(Gencontrol).generate()[0]
+        self.assertEqual(list(packages['linux-common']['Architecture']),
+                         ['amd64'])
+        self.assertRaises(RuntimeError,
+                          self.gencontrol(Gencontrol, jobs=3).generate)
+
+    def test_rerun(self):
+        gencontrol = self.gencontrol()
+        gencontrol()
+        written = gencontrol.files_written
+        self.assertIn('debian/rules.gen', written)
+        gencontrol()
+        self.assertEqual(gencontrol.files_written, [])
+        self.assertEqual(gencontrol.files_unchanged, written)
+
+    def test_timings(self):
+        for jobs in 1, 2:
+            timings = Timings()
+            self.gencontrol(jobs=jobs, timings=timings).generate()
+            self.assertEqual(timings['do_flavour'][0], 6)
+            self.assertEqual(timings['do_flavour_packages'][0], 6)
+            self.assertEqual(timings['merge_build_depends'][0], 1)
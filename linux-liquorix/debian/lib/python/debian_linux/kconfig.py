@@ -1,7 +1,15 @@
-from collections import OrderedDict
+import collections.abc
+import hashlib
+import io
+import re
+import shlex
+import sys
+import unittest
 
 __all__ = (
+    "KconfigChange",
     "KconfigFile",
+    "read_manifest",
 )
 
 
@@ -16,7 +24,7 @@ class KConfigEntry(object):
         return self.name == other.name and self.value == other.value
 
     def __hash__(self):
-        return hash(self.name) | hash(self.value)
+        return hash((self.name, self.value))
 
     def __repr__(self):
         return ('<{}({!r}, {!r}, {!r})>'
@@ -58,36 +66,421 @@ class KConfigEntryTristate(KConfigEntry):
         return '# CONFIG_{} is not set'.format(self.name)
 
 
-class KconfigFile(OrderedDict):
+class KconfigChange(collections.namedtuple('KconfigChange',
+                                           'kind name old new')):
+    __slots__ = ()
+
+    # Kinds of changes; old and new hold the raw values, None if unset
+    ADDED = 'added'
+    REMOVED = 'removed'
+    TRISTATE = 'tristate'
+    VALUE = 'value'
+
+    def __str__(self):
+        if self.kind == self.ADDED:
+            return '+{} {}'.format(self.name, self.new)
+        if self.kind == self.REMOVED:
+            return '-{} {}'.format(self.name, self.old)
+        return ' {} {} -> {}'.format(self.name, self.old, self.new)
+
+
+class KconfigFile(collections.abc.MutableMapping):
+    # Options are not stored as entry objects.  Every symbol gets a slot:
+    # its interned name maps to the slot in _index, which also keeps the
+    # insertion order, the slot's tristate value or _VALUE_STRING is packed
+    # into the _values byte array, and only string values and comments go
+    # into side tables.  Entry objects are built on access; assign them
+    # back to change an option.  The slots of deleted options are kept in
+    # _free and reused for the next new ones.
+    __slots__ = '_index', '_values', '_strings', '_comments', '_free'
+
+    _VALUE_NO, _VALUE_YES, _VALUE_MOD, _VALUE_STRING = range(4)
+
+    _values_tristate = {
+        'n': _VALUE_NO,
+        'y': _VALUE_YES,
+        'm': _VALUE_MOD,
+    }
+
+    _str_tristate = (
+        '# CONFIG_{} is not set',
+        'CONFIG_{}=y',
+        'CONFIG_{}=m',
+    )
+
+    def __init__(self, *args, **kwargs):
+        self._index = {}
+        self._values = bytearray()
+        self._strings = {}
+        self._comments = {}
+        self._free = []
+        self.update(*args, **kwargs)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __delitem__(self, key):
+        slot = self._index.pop(key)
+        self._strings.pop(slot, None)
+        self._comments.pop(slot, None)
+        self._free.append(slot)
+
+    def __getitem__(self, key):
+        slot = self._index[key]
+        value = self._values[slot]
+        if value == self._VALUE_STRING:
+            entry = KConfigEntry(key, self._strings[slot])
+        else:
+            entry = KConfigEntryTristate(key, 'nym'[value])
+        comments = self._comments.get(slot)
+        if comments:
+            entry.comments = list(comments)
+        return entry
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return '<{}({} options)>'.format(self.__class__.__name__, len(self))
+
+    def __setitem__(self, key, entry):
+        if isinstance(entry, KConfigEntryTristate):
+            if entry.value is KConfigEntryTristate.VALUE_MOD:
+                value = 'm'
+            else:
+                value = entry.value and 'y' or 'n'
+        else:
+            value = entry.value
+        slot = self._set(key, value)
+        if entry.comments:
+            self._comments[slot] = list(entry.comments)
+        else:
+            self._comments.pop(slot, None)
+
     def __str__(self):
         ret = []
         for i in self.str_iter():
             ret.append(i)
         return '\n'.join(ret) + '\n'
 
-    def read(self, f):
-        for line in iter(f.readlines()):
-            line = line.strip()
-            if line.startswith("CONFIG_"):
-                i = line.find('=')
-                option = line[7:i]
-                value = line[i + 1:]
-                self.set(option, value)
-            elif line.startswith("# CONFIG_"):
-                option = line[9:-11]
-                self.set(option, 'n')
-            elif line.startswith("#") or not line:
-                pass
+    _line_rules = r"""
+^
+[ \t\r\f\v]*
+(?:
+    CONFIG_
+    (?P<name>
+        [^=\n]*
+    )
+    =
+    (?P<value>
+        (?:[^\n]*\S)?
+    )
+    |
+    \#\ CONFIG_
+    (?P<name_unset>
+        \S+
+    )
+    \ is\ not\ set
+    |
+    \#[^\n]*
+    |
+    (?P<unknown>
+        (?:[^\n]*\S)?
+    )
+)
+[ \t\r\f\v]*
+$
+"""
+    _line_re = re.compile(_line_rules, re.M | re.X)
+
+    def read(self, f, read_size=1 << 16):
+        # Parse the file in chunks of read_size characters, each cut at a
+        # line boundary, so neither the whole file nor a list of its lines
+        # is ever held in memory.
+        rest = ''
+        while True:
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind('\n') + 1
+            rest = chunk[end:]
+            self._read_chunk(chunk, end)
+        if rest:
+            self._read_chunk(rest, len(rest))
+
+    def _read_chunk(self, chunk, end):
+        for match in self._line_re.finditer(chunk, 0, end):
+            name, value, name_unset, unknown = match.groups()
+            if name is not None:
+                self.set(name, value)
+            elif name_unset is not None:
+                self.set(name_unset, 'n')
+            elif unknown:
+                raise RuntimeError("Can't recognize %s" % unknown)
+
+    def _set(self, key, value):
+        slot = self._index.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
             else:
-                raise RuntimeError("Can't recognize %s" % line)
+                slot = len(self._values)
+                self._values.append(self._VALUE_STRING)
+            self._index[sys.intern(key)] = slot
+        code = self._values_tristate.get(value)
+        if code is None:
+            self._values[slot] = self._VALUE_STRING
+            self._strings[slot] = value
+        else:
+            self._values[slot] = code
+            self._strings.pop(slot, None)
+        return slot
+
+    def _update(self, other):
+        values, strings, comments = other._values, other._strings, \
+            other._comments
+        for key, slot in other._index.items():
+            value = values[slot]
+            if value == self._VALUE_STRING:
+                new = self._set(key, strings[slot])
+            else:
+                new = self._set(key, 'nym'[value])
+            if slot in comments:
+                self._comments[new] = list(comments[slot])
+            else:
+                self._comments.pop(new, None)
+
+    def _select(self, others, keep):
+        ret = self.__class__()
+        for key, slot in self._index.items():
+            value = self._value(slot)
+            if keep(other.get_raw(key) == value for other in others):
+                ret._set(key, value)
+        return ret
+
+    def _value(self, slot):
+        value = self._values[slot]
+        if value == self._VALUE_STRING:
+            return self._strings[slot]
+        return 'nym'[value]
+
+    def clear(self):
+        self._index.clear()
+        self._values = bytearray()
+        self._strings.clear()
+        self._comments.clear()
+        self._free = []
+
+    def copy(self):
+        ret = self.__class__()
+        ret._index = self._index.copy()
+        ret._values = self._values[:]
+        ret._strings = self._strings.copy()
+        ret._comments = {k: list(v) for k, v in self._comments.items()}
+        ret._free = self._free[:]
+        return ret
+
+    # Yield a KconfigChange for every option that differs from other, in
+    # one pass over each index.  Removed and changed options come in our
+    # order, added ones after them in the order of other.
+    def diff(self, other):
+        index, other_index = self._index, other._index
+        values, other_values = self._values, other._values
+        string = self._VALUE_STRING
+        for key, slot in index.items():
+            other_slot = other_index.get(key)
+            if other_slot is None:
+                yield KconfigChange(KconfigChange.REMOVED, key,
+                                    self._value(slot), None)
+                continue
+            value, other_value = values[slot], other_values[other_slot]
+            if value != string and other_value != string:
+                if value != other_value:
+                    yield KconfigChange(KconfigChange.TRISTATE, key,
+                                        'nym'[value], 'nym'[other_value])
+            else:
+                old, new = self._value(slot), other._value(other_slot)
+                if old != new:
+                    yield KconfigChange(KconfigChange.VALUE, key, old, new)
+        for key, other_slot in other_index.items():
+            if key not in index:
+                yield KconfigChange(KconfigChange.ADDED, key, None,
+                                    other._value(other_slot))
+
+    # Options set to the same value in none of others
+    def difference(self, *others):
+        return self._select(others, lambda same: not any(same))
+
+    # The value as written in the file: y, m, n or the string value
+    def get_raw(self, key, default=None):
+        slot = self._index.get(key)
+        if slot is None:
+            return default
+        return self._value(slot)
+
+    # Options set to the same value in all of others
+    def intersection(self, *others):
+        return self._select(others, all)
+
+    def items_raw(self):
+        for key, slot in self._index.items():
+            yield key, self._value(slot)
+
+    # Digest of the options and their values only, so reordering options
+    # or changing comments does not change it
+    def digest(self):
+        h = hashlib.sha256()
+        index = self._index
+        for key in sorted(index):
+            h.update('{}={}\n'.format(key, self._value(index[key]))
+                     .encode('utf-8'))
+        return h.hexdigest()
 
     def set(self, key, value):
-        if value in ('y', 'm', 'n'):
-            entry = KConfigEntryTristate(key, value)
+        slot = self._set(key, value)
+        self._comments.pop(slot, None)
+
+    # Options of all configs, later ones winning like merged fragments
+    def union(self, *others):
+        ret = self.copy()
+        for other in others:
+            ret._update(other)
+        return ret
+
+    def update(self, *args, **kwargs):
+        # Merging another KconfigFile copies its slots without building
+        # entry objects
+        if len(args) == 1 and not kwargs and isinstance(args[0], KconfigFile):
+            self._update(args[0])
         else:
-            entry = KConfigEntry(key, value)
-        self[key] = entry
+            super(KconfigFile, self).update(*args, **kwargs)
 
     def str_iter(self):
-        for key, value in self.items():
-            yield str(value)
+        values, strings = self._values, self._strings
+        str_tristate = self._str_tristate
+        for key, slot in self._index.items():
+            value = values[slot]
+            if value == self._VALUE_STRING:
+                yield 'CONFIG_{}={}'.format(key, strings[slot])
+            else:
+                yield str_tristate[value].format(key)
+
+
+class _KconfigFileTest(unittest.TestCase):
+    text = ('CONFIG_A=y\n'
+            '# CONFIG_B is not set\n'
+            '# comment\n'
+            '  CONFIG_C=m  \n'
+            'CONFIG_D="a b"\n'
+            'CONFIG_E=0x10')
+
+    def read(self, text, **kwargs):
+        ret = KconfigFile()
+        ret.read(io.StringIO(text), **kwargs)
+        return ret
+
+    def test_read(self):
+        kconfig = self.read(self.text)
+        self.assertEqual(list(kconfig.items_raw()),
+                         [('A', 'y'), ('B', 'n'), ('C', 'm'),
+                          ('D', '"a b"'), ('E', '0x10')])
+        # Chunks cut anywhere within lines give the same result
+        for read_size in range(1, 12):
+            self.assertEqual(str(self.read(self.text, read_size=read_size)),
+                             str(kconfig))
+        self.assertRaises(RuntimeError, self.read, 'CONFIG_A=y\nbogus\n')
+
+    def test_delete(self):
+        kconfig = self.read(self.text)
+        del kconfig['B']
+        del kconfig['D']
+        kconfig.set('F', 'y')
+        kconfig.set('G', 'string')
+        kconfig.set('H', 'm')
+        # Freed slots are reused before the values grow
+        self.assertEqual(len(kconfig._values), 6)
+        self.assertEqual(list(kconfig.items_raw()),
+                         [('A', 'y'), ('C', 'm'), ('E', '0x10'),
+                          ('F', 'y'), ('G', 'string'), ('H', 'm')])
+        self.assertEqual(kconfig.digest(), KconfigFile(kconfig).digest())
+
+    def test_set_operations(self):
+        a = self.read('CONFIG_A=y\nCONFIG_B=m\nCONFIG_C=1\n')
+        b = self.read('CONFIG_B=m\nCONFIG_C=2\nCONFIG_D=y\n')
+        self.assertEqual(list(a.union(b).items_raw()),
+                         [('A', 'y'), ('B', 'm'), ('C', '2'), ('D', 'y')])
+        self.assertEqual(list(a.intersection(b).items_raw()), [('B', 'm')])
+        self.assertEqual(list(a.difference(b).items_raw()),
+                         [('A', 'y'), ('C', '1')])
+        self.assertEqual(list(a.items_raw()),
+                         [('A', 'y'), ('B', 'm'), ('C', '1')])
+
+    def test_diff(self):
+        a = self.read('CONFIG_A=y\nCONFIG_B=m\nCONFIG_C=1\nCONFIG_D=y\n')
+        b = self.read('CONFIG_E=m\nCONFIG_C=2\nCONFIG_B=y\nCONFIG_D=y\n'
+                      'CONFIG_F="s"\n')
+        self.assertEqual(list(a.diff(b)), [
+            KconfigChange(KconfigChange.REMOVED, 'A', 'y', None),
+            KconfigChange(KconfigChange.TRISTATE, 'B', 'm', 'y'),
+            KconfigChange(KconfigChange.VALUE, 'C', '1', '2'),
+            KconfigChange(KconfigChange.ADDED, 'E', None, 'm'),
+            KconfigChange(KconfigChange.ADDED, 'F', None, '"s"'),
+        ])
+        self.assertEqual([str(i) for i in b.diff(a)][:2],
+                         ['-E m', ' C 2 -> 1'])
+        self.assertEqual(list(a.diff(a.copy())), [])
+
+
+# Every line of a manifest, as written to debian/kconfig.manifest by
+# gencontrol.py, holds the arguments of one merge: the output file name,
+# the input fragments and any "-o NAME=VALUE" overrides.
+def read_manifest(f):
+    name = getattr(f, 'name', 'manifest')
+    for no, line in enumerate(f, 1):
+        args = iter(shlex.split(line, comments=True))
+        files, overrides = [], {}
+        for arg in args:
+            if arg in ('-o', '--override'):
+                option, arg = arg, next(args, None)
+                if arg is None:
+                    raise RuntimeError('%s:%d: %s needs a value' %
+                                       (name, no, option))
+            elif arg.startswith('--override='):
+                arg = arg[len('--override='):]
+            else:
+                files.append(arg)
+                continue
+            if '=' not in arg:
+                raise RuntimeError('%s:%d: override %s is not NAME=VALUE' %
+                                   (name, no, arg))
+            key, value = arg.split('=', 1)
+            overrides[key] = value
+        if files:
+            yield files[0], files[1:], overrides
+
+
+class _ReadManifestTest(unittest.TestCase):
+    def test_read(self):
+        f = io.StringIO(
+            '# comment\n'
+            'config.a x y -o DEBUG_INFO=y\n'
+            "'config b' x --override=A=\"1 2\" --override B=n\n"
+            '\n')
+        self.assertEqual(list(read_manifest(f)), [
+            ('config.a', ['x', 'y'], {'DEBUG_INFO': 'y'}),
+            ('config b', ['x'], {'A': '1 2', 'B': 'n'}),
+        ])
+
+    def test_missing_value(self):
+        f = io.StringIO('config.a x\nconfig.b x -o\n')
+        with self.assertRaisesRegex(RuntimeError, 'manifest:2: -o needs'):
+            list(read_manifest(f))
+
+    def test_bad_override(self):
+        f = io.StringIO('config.a x -o DEBUG\n')
+        with self.assertRaisesRegex(RuntimeError, 'manifest:1: override'):
+            list(read_manifest(f))
@@ -0,0 +1,663 @@
+import io
+import os.path
+import pickle
+import re
+import shutil
+import tempfile
+import unittest
+import warnings
+
+from .kconfig import KconfigFile
+
+__all__ = (
+    "KconfigIndex",
+)
+
+
+class KconfigSymbol(object):
+    __slots__ = 'name', 'type', 'prompts', 'defaults', 'depends', \
+        'selected', 'implied', 'locations'
+
+    def __init__(self, name):
+        self.name = name
+        self.type = None
+        # Dependencies of every prompt, the symbol is visible if one holds
+        self.prompts = []
+        # (value, condition) in order of precedence
+        self.defaults = []
+        # Dependencies of every definition
+        self.depends = []
+        # (symbol, condition) of the select and imply statements naming it
+        self.selected = []
+        self.implied = []
+        self.locations = []
+
+    def __repr__(self):
+        return '<{}({!r}, {!r})>'.format(self.__class__.__name__, self.name,
+                                         self.type)
+
+
+# The symbols of a kernel tree, to check a config without running kbuild.
+# This approximates kbuild: choices and most macros are not evaluated, so
+# its results are only advisory.
+class KconfigIndex(dict):
+    # Bump when the pickled layout changes
+    version = 2
+
+    # The source statements that could not be followed, as "file:line"
+    unresolved = ()
+
+    _types = ('bool', 'tristate', 'string', 'hex', 'int')
+
+    _valid = {
+        'bool': re.compile(r'[yn]$'),
+        'tristate': re.compile(r'[ymn]$'),
+        'string': re.compile(r'"(?:[^"\\]|\\.)*"$'),
+        'hex': re.compile(r'(?:0[xX])?[0-9a-fA-F]+$'),
+        'int': re.compile(r'-?[0-9]+$'),
+    }
+
+    _line_re = re.compile(r'^(\s*)(\S+)\s*(.*?)\s*$')
+
+    @classmethod
+    def build(cls, srctree, srcarch, top='Kconfig'):
+        ret = cls()
+        reader = _Reader(ret, srctree, srcarch)
+        reader.read(top, [])
+        ret.unresolved = reader.unresolved
+        _finalize(ret)
+        return ret
+
+    @classmethod
+    def load(cls, fp):
+        data = pickle.load(fp)
+        if data[0] != cls.version:
+            raise RuntimeError("Kconfig index version %s unsupported" %
+                               data[0])
+        ret = cls()
+        ret.update(data[1])
+        ret.unresolved = data[2]
+        return ret
+
+    def dump(self, fp):
+        pickle.dump((self.version, dict(self), list(self.unresolved)), fp,
+                    pickle.HIGHEST_PROTOCOL)
+
+    # Symbols that are set in the config but defined nowhere.  Nothing is
+    # reported if some source statements could not be followed, as the
+    # symbols may be defined there.
+    def check_unknown(self, kconfig):
+        if self.unresolved:
+            return
+        for name in kconfig:
+            if name not in self:
+                yield name
+
+    # Symbols whose value doesn't match their type, as (name, value, type)
+    def check_mistyped(self, kconfig):
+        for name, value in kconfig.items_raw():
+            symbol = self.get(name)
+            if symbol is None or symbol.type is None:
+                continue
+            if not self._valid[symbol.type].match(value):
+                yield name, value, symbol.type
+
+    # Visible symbols with a prompt that the config doesn't cover, the
+    # symbols "make listnewconfig" should report.  Symbols missing from the
+    # config take the value of their defaults, selects and implies; a
+    # prompt whose condition can't be worked out counts as visible.
+    def check_new(self, kconfig):
+        values = _Values(self, kconfig)
+        for name, symbol in self.items():
+            if not symbol.prompts or name in kconfig:
+                continue
+            for depends in symbol.prompts:
+                if values.evaluate(depends) != 0:
+                    yield name
+                    break
+
+
+class _Reader(object):
+    def __init__(self, index, srctree, srcarch):
+        self.index = index
+        self.srctree, self.srcarch = srctree, srcarch
+        self.unresolved = []
+
+    # Returns None if the path uses macros only kbuild knows
+    def expand(self, value):
+        value = value.strip('"\'')
+        value = value.replace('$(SRCARCH)', self.srcarch) \
+            .replace('$(srctree)/', '')
+        if '$(' in value:
+            return None
+        return value
+
+    # The blocks enclosing a source statement also enclose everything in
+    # the sourced file, so the stack of blocks is passed down
+    def read(self, name, frames, optional=False):
+        filename = os.path.join(self.srctree, name)
+        if not os.path.exists(filename):
+            if optional:
+                return
+            raise RuntimeError("Kconfig file %s not found" % name)
+        with open(filename, encoding='utf-8', errors='replace') as f:
+            self._read(f, name, list(frames))
+
+    def _lines(self, f):
+        # Yield (line number, logical line) with continuations joined
+        pending, pending_no = '', None
+        for no, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if line.endswith('\\'):
+                if pending_no is None:
+                    pending_no = no
+                pending += line[:-1]
+                continue
+            if pending_no is not None:
+                yield pending_no, pending + line
+                pending, pending_no = '', None
+            else:
+                yield no, line
+        if pending_no is not None:
+            yield pending_no, pending
+
+    def _read(self, f, name, frames):
+        # frames is the stack of the enclosing if, menu and choice blocks
+        depth = len(frames)
+        # The symbol, menu or choice the attributes apply to
+        current = None
+        help_indent = None
+        in_help = False
+
+        for no, line in self._lines(f):
+            if in_help:
+                stripped = line.lstrip()
+                if not stripped:
+                    continue
+                indent = len(line.expandtabs()) - len(stripped.expandtabs())
+                if help_indent is None:
+                    help_indent = indent
+                if indent >= help_indent and indent > 0:
+                    continue
+                in_help = False
+
+            match = self.index._line_re.match(_strip_comment(line))
+            if not match:
+                continue
+            keyword, rest = match.group(2), match.group(3)
+
+            if keyword in ('config', 'menuconfig'):
+                symbol = self.index.get(rest)
+                if symbol is None:
+                    symbol = self.index[rest] = KconfigSymbol(rest)
+                symbol.locations.append('%s:%d' % (name, no))
+                current = _Definition(symbol, frames)
+            elif keyword == 'choice':
+                current = _Frame(None)
+                frames.append(current)
+            elif keyword == 'menu':
+                current = _Frame(None)
+                frames.append(current)
+            elif keyword == 'if':
+                current = None
+                frames.append(_Frame(rest))
+            elif keyword in ('endif', 'endmenu', 'endchoice'):
+                current = None
+                if len(frames) > depth:
+                    frames.pop()
+            elif keyword in ('source', 'rsource', 'osource', 'orsource'):
+                current = None
+                path = self.expand(rest)
+                if path is None:
+                    warnings.warn('%s:%d: can\'t follow source %s' %
+                                  (name, no, rest))
+                    self.unresolved.append('%s:%d' % (name, no))
+                    continue
+                if keyword.startswith('r') or keyword.startswith('or'):
+                    path = os.path.join(os.path.dirname(name), path)
+                self.read(path, frames, optional=keyword.startswith('o'))
+            elif keyword in ('comment', 'mainmenu'):
+                current = None
+            elif keyword in ('help', '---help---'):
+                in_help, help_indent = True, None
+            elif keyword == 'depends':
+                if rest.startswith('on '):
+                    rest = rest[3:]
+                if current is not None:
+                    current.add_depends(rest.strip())
+            elif isinstance(current, _Definition):
+                current.add_attribute(keyword, rest)
+
+        if len(frames) > depth:
+            warnings.warn('%s: unterminated block' % name)
+
+
+class _Frame(object):
+    __slots__ = 'depends',
+
+    def __init__(self, depends):
+        self.depends = depends and [depends] or []
+
+    def add_depends(self, expr):
+        self.depends.append(expr)
+
+
+class _Definition(object):
+    __slots__ = 'symbol', 'frames', 'own', 'selects'
+
+    _prompt_re = re.compile(r'^("(?:[^"\\]|\\.)*"|\'[^\']*\')'
+                            r'(?:\s+if\s+(.*))?$')
+    _cond_re = re.compile(r'^(.*?)(?:\s+if\s+(.*))?$')
+
+    def __init__(self, symbol, frames):
+        self.symbol = symbol
+        # The enclosing blocks, their dependencies may still grow
+        self.frames = list(frames)
+        self.own = []
+        # (keyword, symbol, condition) of its select and imply statements
+        self.selects = []
+        symbol.depends.append(self)
+
+    def add_depends(self, expr):
+        self.own.append(expr)
+
+    def add_attribute(self, keyword, rest):
+        symbol = self.symbol
+        if keyword.startswith('def_'):
+            keyword, default = keyword[4:], rest
+            rest = ''
+        else:
+            default = None
+        if keyword in KconfigIndex._types:
+            if symbol.type is None:
+                symbol.type = keyword
+            if rest:
+                self.add_prompt(rest)
+            if default is not None:
+                self.add_default(default)
+        elif keyword == 'prompt':
+            self.add_prompt(rest)
+        elif keyword == 'default':
+            self.add_default(rest)
+        elif keyword in ('select', 'imply'):
+            self.selects.append((keyword, ) + self._cond_re.match(rest).groups())
+
+    def add_prompt(self, rest):
+        match = self._prompt_re.match(rest)
+        cond = match and match.group(2)
+        self.symbol.prompts.append((self, cond))
+
+    def add_default(self, rest):
+        value, cond = self._cond_re.match(rest).groups()
+        self.symbol.defaults.append((value, cond))
+
+    def expression(self, extra=None):
+        exprs = []
+        for frame in self.frames:
+            exprs.extend(frame.depends)
+        exprs.extend(self.own)
+        if extra:
+            exprs.append(extra)
+        return ' && '.join('(%s)' % i for i in exprs) or 'y'
+
+
+def _finalize(index):
+    # Record select and imply statements on the symbols they name, the
+    # ones naming an undefined symbol have no effect
+    for symbol in index.values():
+        for definition in symbol.depends:
+            for keyword, name, cond in definition.selects:
+                target = index.get(name)
+                if target is None:
+                    continue
+                if keyword == 'select':
+                    target.selected.append((symbol.name, cond))
+                else:
+                    target.implied.append((symbol.name, cond))
+
+    # Replace the definitions, which reference the block stack, by their
+    # flattened dependency expressions
+    for symbol in index.values():
+        symbol.prompts = [definition.expression(cond)
+                          for definition, cond in symbol.prompts]
+        symbol.depends = [definition.expression()
+                          for definition in symbol.depends]
+
+
+def _strip_comment(line):
+    quote = None
+    for i, c in enumerate(line):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '#':
+            return line[:i]
+    return line
+
+
+class _Expression(object):
+    __slots__ = 'tokens', 'pos'
+
+    _token_re = re.compile(r'\s*(\(|\)|&&|\|\||!=|<=|>=|=|<|>|!|'
+                           r'"(?:[^"\\]|\\.)*"|\'[^\']*\'|'
+                           r'\$\([^)]*\)|[^\s()!=<>&|"\']+)')
+
+    _tristate = {'n': 0, 'm': 1, 'y': 2}
+
+    _number_re = re.compile(r'^-?(?:0[xX][0-9a-fA-F]+|[0-9]+)$')
+
+    # tokens is None if the text can't be parsed
+    def __init__(self, text):
+        self.tokens, self.pos = [], 0
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            match = self._token_re.match(text, pos)
+            if not match:
+                self.tokens = None
+                break
+            self.tokens.append(match.group(1))
+            pos = match.end()
+
+    # Return 0, 1 or 2 for n, m or y, or None if the expression can't be
+    # evaluated without kbuild (macros, unsupported syntax).  lookup
+    # returns the value of a symbol, or None if it is unknown.
+    def evaluate(self, lookup):
+        if not self.tokens:
+            return None
+        # Working out a symbol may evaluate this expression again
+        saved, self.pos = self.pos, 0
+        try:
+            ret = self._or(lookup)
+            if self.pos != len(self.tokens):
+                return None
+            return ret
+        except (IndexError, ValueError):
+            return None
+        finally:
+            self.pos = saved
+
+    # The value of an expression made of a single symbol or constant, as
+    # the default of a string, int or hex symbol is
+    def value(self, lookup):
+        if not self.tokens or len(self.tokens) != 1:
+            return None
+        return self._value(self.tokens[0], lookup)
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _or(self, lookup):
+        ret = self._and(lookup)
+        while self._peek() == '||':
+            self._next()
+            right = self._and(lookup)
+            ret = None if ret is None or right is None else max(ret, right)
+        return ret
+
+    def _and(self, lookup):
+        ret = self._not(lookup)
+        while self._peek() == '&&':
+            self._next()
+            right = self._not(lookup)
+            ret = None if ret is None or right is None else min(ret, right)
+        return ret
+
+    def _not(self, lookup):
+        if self._peek() == '!':
+            self._next()
+            ret = self._not(lookup)
+            return None if ret is None else 2 - ret
+        return self._primary(lookup)
+
+    def _primary(self, lookup):
+        token = self._next()
+        if token == '(':
+            ret = self._or(lookup)
+            if self._next() != ')':
+                raise ValueError
+            return ret
+        left = self._value(token, lookup)
+        op = self._peek()
+        if op in ('=', '!=', '<', '>', '<=', '>='):
+            self._next()
+            right = self._value(self._next(), lookup)
+            if left is None or right is None:
+                return None
+            return self._compare(op, left, right) and 2 or 0
+        if left is None:
+            return None
+        return self._tristate.get(left, 0)
+
+    def _value(self, token, lookup):
+        if token.startswith('$('):
+            return None
+        if token[0] in '"\'':
+            return token[1:-1]
+        if token in self._tristate:
+            return token
+        if self._number_re.match(token):
+            return token
+        return lookup(token)
+
+    @staticmethod
+    def _compare(op, left, right):
+        try:
+            left, right = int(left, 0), int(right, 0)
+        except ValueError:
+            pass
+        if op == '=':
+            return left == right
+        if op == '!=':
+            return left != right
+        try:
+            if op == '<':
+                return left < right
+            if op == '>':
+                return left > right
+            if op == '<=':
+                return left <= right
+            return left >= right
+        except TypeError:
+            raise ValueError
+
+
+# The values of the symbols of index for a config, as after "make
+# olddefconfig": as set in the config, or else worked out from the
+# defaults, selects and implies.  Choices are not handled.
+class _Values(object):
+    def __init__(self, index, kconfig):
+        self.index, self.kconfig = index, kconfig
+        self.values = {}
+        self.expressions = {}
+
+    def expression(self, text):
+        ret = self.expressions.get(text)
+        if ret is None:
+            ret = self.expressions[text] = _Expression(text)
+        return ret
+
+    def evaluate(self, text):
+        return self.expression(text).evaluate(self)
+
+    # The value of a symbol, or None if it can't be worked out.  Symbols
+    # defined nowhere are n, like in kbuild.
+    def __call__(self, name):
+        value = self.kconfig.get_raw(name)
+        if value is not None:
+            if value.startswith('"'):
+                return value[1:-1]
+            return value
+        if name in self.values:
+            return self.values[name]
+        symbol = self.index.get(name)
+        if symbol is None:
+            return 'n'
+        # A symbol depending on itself can't be worked out
+        self.values[name] = None
+        ret = self.values[name] = self._default(symbol)
+        return ret
+
+    def _default(self, symbol):
+        depends = self._any(symbol.depends)
+        if depends is None or symbol.type is None:
+            return None
+
+        if symbol.type not in ('bool', 'tristate'):
+            if not depends:
+                return ''
+            for default, cond in symbol.defaults:
+                cond = 2 if cond is None else self.evaluate(cond)
+                if cond is None:
+                    return None
+                if cond:
+                    return self.expression(default).value(self)
+            return ''
+
+        value = 0
+        for default, cond in symbol.defaults:
+            cond = 2 if cond is None else self.evaluate(cond)
+            if cond is None:
+                return None
+            if cond:
+                value = self.evaluate(default)
+                if value is None:
+                    return None
+                value = min(value, cond)
+                break
+        implied = self._reverse(symbol.implied)
+        selected = self._reverse(symbol.selected)
+        if implied is None or selected is None:
+            return None
+        # Implies only raise the default, selects override the dependencies
+        value = max(min(max(value, implied), depends), selected)
+        if symbol.type == 'bool' and value == 1:
+            value = 2
+        return 'nmy'[value]
+
+    # Any of the dependencies of the definitions
+    def _any(self, expressions):
+        ret = 0
+        for text in expressions:
+            value = self.evaluate(text)
+            if value is None:
+                return None
+            ret = max(ret, value)
+        return ret
+
+    def _reverse(self, entries):
+        ret = 0
+        for name, cond in entries:
+            value = self(name)
+            if value is None:
+                return None
+            value = _Expression._tristate.get(value, 0)
+            if cond is not None:
+                cond = self.evaluate(cond)
+                if cond is None:
+                    return None
+                value = min(value, cond)
+            ret = max(ret, value)
+        return ret
+
+
+class _KconfigIndexTest(unittest.TestCase):
+    files = {
+        'Kconfig': (
+            'source "arch/$(SRCARCH)/Kconfig"\n'
+            'source "$(KCONFIG_EXT)/Kconfig"\n'
+            'config A\n'
+            '\tbool "A"\n'
+            '\tdefault y\n'
+            'config B\n'
+            '\ttristate "B"\n'
+            '\tdepends on A\n'
+            'config HIDDEN\n'
+            '\tbool\n'
+            'config SELECTOR\n'
+            '\tbool "Selector"\n'
+            '\tselect HIDDEN\n'
+            'config C\n'
+            '\tbool "C"\n'
+            '\tdepends on HIDDEN\n'
+            'config S\n'
+            '\tstring "S"\n'
+            '\tdepends on $(success,true) && A\n'
+        ),
+        'arch/x86/Kconfig': (
+            'config X86\n'
+            '\tdef_bool y\n'
+            'config D\n'
+            '\tint "D" if X86 = y && A <= y\n'
+        ),
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, text in self.files.items():
+            os.makedirs(os.path.join(self.dir, os.path.dirname(name)),
+                        exist_ok=True)
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(text)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.index = KconfigIndex.build(self.dir, 'x86')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def config(self, text):
+        ret = KconfigFile()
+        ret.read(io.StringIO(text))
+        return ret
+
+    def test_unresolved(self):
+        self.assertEqual(self.index.unresolved, ['Kconfig:2'])
+        self.assertEqual(list(self.index.check_unknown(
+            self.config('CONFIG_Z=y\n'))), [])
+
+    def test_new_defaults(self):
+        # A is missing but defaults to y, so B is visible
+        self.assertEqual(
+            sorted(self.index.check_new(self.config('CONFIG_SELECTOR=n\n'))),
+            ['A', 'B', 'D', 'S'])
+        self.assertEqual(
+            sorted(self.index.check_new(self.config(
+                'CONFIG_A=n\nCONFIG_SELECTOR=n\n'))),
+            ['D', 'S'])
+
+    def test_new_select(self):
+        self.assertEqual(
+            sorted(self.index.check_new(self.config(
+                'CONFIG_A=n\nCONFIG_SELECTOR=y\nCONFIG_D=1\n'))),
+            ['C', 'S'])
+
+    def test_mistyped(self):
+        self.assertEqual(
+            list(self.index.check_mistyped(self.config(
+                'CONFIG_A=m\nCONFIG_D=x\nCONFIG_B=m\n'))),
+            [('A', 'm', 'bool'), ('D', 'x', 'int')])
+
+    def test_unparsable(self):
+        self.assertIsNone(_Expression('A = "').evaluate(lambda name: 'y'))
+
+    def test_dump(self):
+        f = io.BytesIO()
+        self.index.dump(f)
+        f.seek(0)
+        index = KconfigIndex.load(f)
+        self.assertEqual(sorted(index), sorted(self.index))
+        self.assertEqual(index.unresolved, self.index.unresolved)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import codecs
 import os
 import re
+import shutil
+import tempfile
 import textwrap
+import time
+import unittest
+from collections import OrderedDict
 
 
 class Templates(object):
@@ -102,6 +107,171 @@ def _read_rfc822(f, cls):
     return entries
 
 
+# Write the entries, as read by read_control(), with a single write
+def write_rfc822(f, entries):
+    out = []
+    for entry in entries:
+        for key, value in entry.items():
+            out.append(u"%s: %s\n" % (key, value))
+        out.append('\n')
+    f.write(''.join(out))
+
+
+# A text with @name@ variables, split once into literal text, at even
+# positions, and variable names, at odd ones.  Templates are shared by
+# text, so every distinct text is split only once.
+class Template(object):
+    __slots__ = '_parts'
+
+    _re = re.compile(r'@([-_a-z0-9]+)@')
+
+    _cache = {}
+    _cache_size = 1 << 12
+
+    def __new__(cls, text):
+        cache = cls._cache
+        ret = cache.get(text)
+        if ret is None:
+            ret = super(Template, cls).__new__(cls)
+            ret._parts = cls._re.split(text)
+            if len(cache) >= cls._cache_size:
+                cache.clear()
+            cache[text] = ret
+        return ret
+
+    def substitute(self, vars):
+        parts = self._parts
+        if len(parts) == 1:
+            return parts[0]
+        ret = parts[:]
+        for i in range(1, len(parts), 2):
+            ret[i] = vars[parts[i]]
+        return ''.join(ret)
+
+
+class _TemplateTest(unittest.TestCase):
+    def test_substitute(self):
+        template = Template('@a@-@b_1@ @ x@@a@')
+        self.assertEqual(template.substitute({'a': '1', 'b_1': '2'}),
+                         '1-2 @ x@1')
+        self.assertEqual(Template('plain').substitute({}), 'plain')
+        self.assertRaises(KeyError, template.substitute, {'a': '1'})
+
+    def test_shared(self):
+        self.assertIs(Template('@a@'), Template('@a@'))
+
+
+# Make the file name hold data, text being written as UTF-8, and have the
+# mode given.  A file that already holds exactly that is left alone, so
+# its mtime doesn't change; otherwise the data goes to a temporary file
+# that replaces it, so nobody sees a partial file.  A new file gets the
+# default mode and a replaced one keeps its mode, unless mode is given.
+# Returns whether the file was changed.
+def update_file(name, data, mode=None):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    try:
+        st = os.stat(name)
+        with open(name, 'rb') as f:
+            same = f.read() == data
+    except FileNotFoundError:
+        st = None
+    else:
+        if mode is None:
+            mode = st.st_mode & 0o7777
+        if same:
+            if mode == st.st_mode & 0o7777:
+                return False
+            os.chmod(name, mode)
+            return True
+    if mode is None:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    dir, base = os.path.split(name)
+    fd, tmp = tempfile.mkstemp(dir=dir or '.', prefix=base + '.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            os.chmod(f.fileno(), mode)
+        os.replace(tmp, name)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+class _UpdateFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.name = os.path.join(self.dir, 'file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.name, 'rb') as f:
+            return f.read()
+
+    def test_update(self):
+        self.assertTrue(update_file(self.name, 'caf\xe9\n', 0o640))
+        self.assertEqual(self.read(), b'caf\xc3\xa9\n')
+        self.assertEqual(os.stat(self.name).st_mode & 0o7777, 0o640)
+        os.utime(self.name, (0, 0))
+        # The same content leaves the file alone
+        self.assertFalse(update_file(self.name, b'caf\xc3\xa9\n'))
+        self.assertEqual(os.stat(self.name).st_mtime, 0)
+        # A new content replaces the file and keeps its mode
+        self.assertTrue(update_file(self.name, 'new\n'))
+        self.assertEqual(self.read(), b'new\n')
+        self.assertEqual(os.stat(self.name).st_mode & 0o7777, 0o640)
+        # A new mode alone only changes the mode
+        self.assertTrue(update_file(self.name, 'new\n', 0o755))
+        self.assertEqual(os.stat(self.name).st_mode & 0o7777, 0o755)
+        self.assertEqual(os.listdir(self.dir), ['file'])
+
+    def test_replace(self):
+        update_file(self.name, 'old\n')
+        with open(self.name, 'rb') as f:
+            update_file(self.name, 'new\n')
+            # Readers of the old file still see all of it
+            self.assertEqual(f.read(), b'old\n')
+        self.assertEqual(self.read(), b'new\n')
+
+
+# Number of calls and wall time in seconds by method name.  The time of a
+# method includes that of the methods it calls.
+class Timings(OrderedDict):
+    # Replace the methods names of obj by timed ones, on the instance
+    def instrument(self, obj, names):
+        for name in names:
+            setattr(obj, name, self.wrap(name, getattr(obj, name)))
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, 1, time.perf_counter() - start)
+        return timed
+
+    def add(self, name, calls, seconds):
+        old_calls, old_seconds = self.get(name, (0, 0.))
+        self[name] = old_calls + calls, old_seconds + seconds
+
+    def merge(self, other):
+        for name, (calls, seconds) in other.items():
+            self.add(name, calls, seconds)
+
+    def write(self, f):
+        for name, (calls, seconds) in sorted(self.items(),
+                                             key=lambda i: -i[1][1]):
+            f.write('%-40s %8d %12.3f ms\n' % (name, calls, seconds * 1000))
+
+
 class TextWrapper(textwrap.TextWrapper):
     wordsep_re = re.compile(
         r'(\s+|'                                  # any whitespace